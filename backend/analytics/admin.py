@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Report, ReportExecution, Certificate, HRMetric
+from .models import Report, ReportExecution, ReportBlob, Certificate, HRMetric, MetricDelta, MetricsJob
 
 
 @admin.register(Report)
@@ -36,6 +36,16 @@ class ReportExecutionAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(ReportBlob)
+class ReportBlobAdmin(admin.ModelAdmin):
+    list_display = ['digest', 'size', 'compressed_size', 'created_at']
+    search_fields = ['digest']
+    readonly_fields = ['digest', 'file', 'size', 'compressed_size', 'created_at']
+    
+    def has_add_permission(self, request):
+        return False
+
+
 @admin.register(Certificate)
 class CertificateAdmin(admin.ModelAdmin):
     list_display = ['name', 'employee', 'certificate_type', 'expiry_date', 'status', 'days_until_expiry']
@@ -83,8 +93,8 @@ class CertificateAdmin(admin.ModelAdmin):
 
 @admin.register(HRMetric)
 class HRMetricAdmin(admin.ModelAdmin):
-    list_display = ['metric_type', 'value', 'percentage_value', 'date', 'department', 'created_at']
-    list_filter = ['metric_type', 'date', 'department', 'year', 'quarter']
+    list_display = ['metric_type', 'value', 'percentage_value', 'date', 'granularity', 'department', 'created_at']
+    list_filter = ['metric_type', 'granularity', 'date', 'department', 'year', 'quarter']
     search_fields = ['metric_type']
     readonly_fields = ['created_at']
     
@@ -93,7 +103,7 @@ class HRMetricAdmin(admin.ModelAdmin):
             'fields': ('metric_type', 'value', 'percentage_value')
         }),
         ('Time Dimension', {
-            'fields': ('date', 'month', 'year', 'quarter')
+            'fields': ('date', 'granularity', 'month', 'year', 'quarter')
         }),
         ('Dimensions', {
             'fields': ('department', 'location')
@@ -102,4 +112,18 @@ class HRMetricAdmin(admin.ModelAdmin):
             'fields': ('calculation_details', 'created_at'),
             'classes': ('collapse',)
         })
-    )
\ No newline at end of file
+    )
+
+
+@admin.register(MetricDelta)
+class MetricDeltaAdmin(admin.ModelAdmin):
+    list_display = ['change_type', 'employee', 'department', 'effective_date', 'created_at', 'processed_at']
+    list_filter = ['change_type', 'effective_date', 'processed_at']
+    readonly_fields = ['created_at', 'processed_at']
+
+
+@admin.register(MetricsJob)
+class MetricsJobAdmin(admin.ModelAdmin):
+    list_display = ['start_date', 'end_date', 'status', 'completed_chunks', 'total_chunks', 'rows_written', 'started_at']
+    list_filter = ['status', 'started_at']
+    readonly_fields = ['started_at', 'completed_at']
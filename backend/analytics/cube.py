@@ -0,0 +1,186 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from .models import HRMetric, DataVersion
+from .utils import HR_METRICS_VERSION_KEY
+
+
+METRIC_TYPES = [metric_type for metric_type, _ in HRMetric.METRIC_TYPES]
+
+DIMENSIONS = ['metric_type', 'date', 'month', 'quarter', 'year', 'department', 'location']
+
+ROLLUPS = ['sum', 'avg', 'min', 'max', 'last', 'count']
+
+MEASURES = ['value', 'percentage_value']
+
+# Company-wide rows have no department
+NO_DEPARTMENT = -1
+
+CubeData = namedtuple('CubeData', [
+    'version', 'metric_type', 'day', 'month', 'quarter', 'year',
+    'department', 'location', 'locations', 'value', 'percentage_value',
+])
+
+
+class HRMetricCube:
+    """
+    Columnar, in-memory copy of HRMetric for slice-and-dice queries.
+
+    Each HRMetric row is one position in a set of parallel NumPy arrays
+    (metric type, date parts, department, location and the two measures).
+    The arrays are loaded on first use and reloaded whenever the
+    hr_metrics DataVersion has moved on, so queries never see stale data
+    and never hit the metrics table while it is unchanged.
+    """
+
+    def __init__(self):
+        self._data = None
+        self._lock = threading.Lock()
+
+    def get_data(self):
+        """Return the current arrays, reloading them if HR metrics changed"""
+        version = DataVersion.current([HR_METRICS_VERSION_KEY])[0]
+        data = self._data
+        if data is None or data.version != version:
+            with self._lock:
+                data = self._data
+                if data is None or data.version != version:
+                    data = self._data = self._load(version)
+        return data
+
+    def _load(self, version):
+        rows = HRMetric.objects.filter(granularity='day').order_by().values_list(
+            'metric_type', 'date', 'department_id', 'location', 'value', 'percentage_value'
+        )
+
+        metric_codes = {metric_type: code for code, metric_type in enumerate(METRIC_TYPES)}
+        metric_type, days, department, location, value, percentage_value = [], [], [], [], [], []
+        for row in rows.iterator(chunk_size=5000):
+            metric_type.append(metric_codes.get(row[0], -1))
+            days.append(row[1])
+            department.append(row[2] if row[2] is not None else NO_DEPARTMENT)
+            location.append(row[3] or '')
+            value.append(row[4])
+            percentage_value.append(row[5] if row[5] is not None else np.nan)
+
+        day = np.array(days, dtype='datetime64[D]')
+        month_index = day.astype('datetime64[M]').astype(np.int64)
+        locations, location_codes = np.unique(np.array(location, dtype=object).astype(str), return_inverse=True)
+
+        return CubeData(
+            version=version,
+            metric_type=np.array(metric_type, dtype=np.int16),
+            day=day.astype(np.int64),
+            month=month_index,
+            quarter=month_index // 3,
+            year=day.astype('datetime64[Y]').astype(np.int64),
+            department=np.array(department, dtype=np.int64),
+            location=location_codes.astype(np.int32),
+            locations=locations,
+            value=np.array(value, dtype=np.float64),
+            percentage_value=np.array(percentage_value, dtype=np.float64),
+        )
+
+    def query(self, metric_types=None, start_date=None, end_date=None, department_ids=None,
+              locations=None, group_by=('month',), rollup='sum', measure='value'):
+        """
+        Filter the cube and aggregate the measure over the group_by dimensions.
+
+        Results are always split by metric type. Department rows are only
+        used when grouping or filtering by department; otherwise the
+        company-wide rows are used so totals are not counted twice.
+        """
+        group_by = [dimension for dimension in group_by if dimension != 'metric_type']
+        unknown = set(group_by) - set(DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Unknown group_by dimension(s): {', '.join(sorted(unknown))}")
+        if rollup not in ROLLUPS:
+            raise ValueError(f"Unknown rollup: {rollup}")
+        if measure not in MEASURES:
+            raise ValueError(f"Unknown measure: {measure}")
+
+        data = self.get_data()
+        values = getattr(data, measure)
+        mask = ~np.isnan(values) & (data.metric_type >= 0)
+
+        if metric_types:
+            unknown = set(metric_types) - set(METRIC_TYPES)
+            if unknown:
+                raise ValueError(f"Unknown metric type(s): {', '.join(sorted(unknown))}")
+            mask &= np.isin(data.metric_type, [METRIC_TYPES.index(m) for m in metric_types])
+        if start_date:
+            mask &= data.day >= np.datetime64(start_date, 'D').astype(np.int64)
+        if end_date:
+            mask &= data.day <= np.datetime64(end_date, 'D').astype(np.int64)
+        if department_ids:
+            mask &= np.isin(data.department, [int(dept_id) for dept_id in department_ids])
+        elif 'department' in group_by:
+            mask &= data.department != NO_DEPARTMENT
+        else:
+            mask &= data.department == NO_DEPARTMENT
+        if locations:
+            mask &= np.isin(data.location, np.flatnonzero(np.isin(data.locations, locations)))
+
+        columns = {
+            'metric_type': data.metric_type[mask],
+            'date': data.day[mask],
+            'month': data.month[mask],
+            'quarter': data.quarter[mask],
+            'year': data.year[mask],
+            'department': data.department[mask],
+            'location': data.location[mask],
+        }
+        values = values[mask]
+        if not len(values):
+            return []
+
+        key_columns = [columns['metric_type']] + [columns[dimension] for dimension in group_by]
+        keys, groups = np.unique(np.stack(key_columns, axis=1), axis=0, return_inverse=True)
+        groups = groups.ravel()
+        counts = np.bincount(groups, minlength=len(keys))
+
+        if rollup == 'sum':
+            result = np.bincount(groups, weights=values, minlength=len(keys))
+        elif rollup == 'avg':
+            result = np.bincount(groups, weights=values, minlength=len(keys)) / counts
+        elif rollup == 'count':
+            result = counts.astype(np.float64)
+        elif rollup == 'min':
+            result = np.full(len(keys), np.inf)
+            np.minimum.at(result, groups, values)
+        elif rollup == 'max':
+            result = np.full(len(keys), -np.inf)
+            np.maximum.at(result, groups, values)
+        else:  # last
+            order = np.lexsort((columns['date'], groups))
+            last = np.flatnonzero(np.r_[groups[order][1:] != groups[order][:-1], True])
+            result = values[order][last]
+
+        return [
+            self._format_group(key, group_by, data.locations, float(result[i]))
+            for i, key in enumerate(keys)
+        ]
+
+    def _format_group(self, key, group_by, locations, value):
+        group = {'metric_type': METRIC_TYPES[key[0]]}
+        for dimension, code in zip(group_by, key[1:]):
+            code = int(code)
+            if dimension == 'date':
+                group['date'] = str(np.datetime64(code, 'D'))
+            elif dimension == 'month':
+                group['month'] = str(np.datetime64(code, 'M'))
+            elif dimension == 'quarter':
+                group['quarter'] = f"{1970 + code // 4}-Q{code % 4 + 1}"
+            elif dimension == 'year':
+                group['year'] = 1970 + code
+            elif dimension == 'department':
+                group['department'] = None if code == NO_DEPARTMENT else code
+            elif dimension == 'location':
+                group['location'] = str(locations[code])
+        group['value'] = round(value, 4)
+        return group
+
+
+hr_metric_cube = HRMetricCube()
@@ -0,0 +1,392 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.exceptions import FieldError, ValidationError
+from django.db.models import Avg, Count, F, IntegerField, Max, Min, Q, Sum, Value
+from django.db.models.functions import Cast, ExtractYear, TruncMonth, TruncQuarter, TruncWeek
+from employees.models import Department, Designation, Employee, EmployeeTimeline
+from leave.models import LeaveBalance, LeaveRequest, LeaveType
+
+from .models import Certificate
+
+
+# A base entity of custom reports: its model, the fields that may be
+# selected, filtered or grouped on, the relations that may be joined (name to
+# (ORM path, entity name)) and the columns shown when a spec selects none
+CustomReportEntity = namedtuple('CustomReportEntity', ['model', 'fields', 'joins', 'default_columns'])
+
+ENTITIES = {
+    'employee': CustomReportEntity(
+        Employee,
+        ['employee_id', 'first_name', 'last_name', 'email', 'gender', 'marital_status', 'nationality',
+         'date_of_joining', 'employment_status', 'employment_type', 'is_active'],
+        {
+            'department': ('department', 'department'),
+            'designation': ('designation', 'designation'),
+            'manager': ('reporting_manager', 'employee'),
+        },
+        ['employee_id', 'first_name', 'last_name', 'department.name', 'designation.title', 'date_of_joining'],
+    ),
+    'department': CustomReportEntity(
+        Department,
+        ['id', 'name', 'is_active'],
+        {'parent': ('parent_department', 'department')},
+        ['id', 'name', 'is_active'],
+    ),
+    'designation': CustomReportEntity(
+        Designation,
+        ['id', 'title', 'is_active'],
+        {'department': ('department', 'department')},
+        ['id', 'title', 'department.name'],
+    ),
+    'leave_type': CustomReportEntity(
+        LeaveType,
+        ['id', 'name', 'is_paid', 'requires_approval', 'max_days_per_year', 'is_active'],
+        {},
+        ['id', 'name', 'is_paid', 'max_days_per_year'],
+    ),
+    'leave_request': CustomReportEntity(
+        LeaveRequest,
+        ['id', 'start_date', 'end_date', 'half_day', 'status', 'approved_at', 'created_at'],
+        {
+            'employee': ('employee', 'employee'),
+            'department': ('employee__department', 'department'),
+            'designation': ('employee__designation', 'designation'),
+            'leave_type': ('leave_type', 'leave_type'),
+            'approver': ('approved_by', 'employee'),
+        },
+        ['id', 'employee.first_name', 'employee.last_name', 'leave_type.name', 'start_date', 'end_date', 'status'],
+    ),
+    'leave_balance': CustomReportEntity(
+        LeaveBalance,
+        ['id', 'year', 'total_days', 'used_days', 'pending_days', 'carried_forward_days'],
+        {
+            'employee': ('employee', 'employee'),
+            'department': ('employee__department', 'department'),
+            'leave_type': ('leave_type', 'leave_type'),
+        },
+        ['employee.first_name', 'employee.last_name', 'leave_type.name', 'year', 'total_days', 'used_days'],
+    ),
+    'certificate': CustomReportEntity(
+        Certificate,
+        ['id', 'name', 'certificate_type', 'issuing_authority', 'issue_date', 'expiry_date', 'status'],
+        {
+            'employee': ('employee', 'employee'),
+            'department': ('employee__department', 'department'),
+        },
+        ['employee.first_name', 'employee.last_name', 'name', 'certificate_type', 'expiry_date', 'status'],
+    ),
+    'timeline_event': CustomReportEntity(
+        EmployeeTimeline,
+        ['id', 'event_type', 'title', 'event_date'],
+        {
+            'employee': ('employee', 'employee'),
+            'department': ('employee__department', 'department'),
+        },
+        ['employee.first_name', 'employee.last_name', 'event_type', 'title', 'event_date'],
+    ),
+}
+
+# Every model a custom report can read
+CUSTOM_REPORT_MODELS = list({entity.model for entity in ENTITIES.values()})
+
+# Spec operator to (ORM lookup, negated)
+OPERATORS = {
+    'eq': ('exact', False),
+    'ne': ('exact', True),
+    'lt': ('lt', False),
+    'lte': ('lte', False),
+    'gt': ('gt', False),
+    'gte': ('gte', False),
+    'in': ('in', False),
+    'not_in': ('in', True),
+    'between': ('range', False),
+    'contains': ('icontains', False),
+    'startswith': ('istartswith', False),
+    'isnull': ('isnull', False),
+}
+
+AGGREGATES = {
+    'count': Count,
+    'sum': Sum,
+    'avg': Avg,
+    'min': Min,
+    'max': Max,
+}
+
+# Date parts a field reference may be truncated to with a "field:part" suffix
+DATE_PARTS = {
+    'week': TruncWeek,
+    'month': TruncMonth,
+    'quarter': TruncQuarter,
+    'year': ExtractYear,
+}
+
+AGGREGATE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# A compiled custom report: the output columns, the queryset selecting them
+# (computed columns annotated under their own names) and the models it reads
+CompiledReport = namedtuple('CompiledReport', ['digest', 'columns', 'queryset', 'models'])
+
+
+def spec_digest(spec, columns):
+    """Hash of a custom report spec and its selected columns"""
+    canonical = json.dumps({'spec': spec or {}, 'columns': columns or []}, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class CustomReportCompiler:
+    """
+    Compile declarative custom report specs into a single ORM query.
+
+    A spec, stored in Report.filters, names a base entity and optionally
+    joins, where conditions, group_by fields, aggregates and an ordering:
+
+        {
+            "entity": "leave_request",
+            "where": [{"field": "status", "op": "eq", "value": "APPROVED"}],
+            "group_by": ["department.name", "start_date:month"],
+            "aggregates": [{"name": "requests", "function": "count"}],
+            "order_by": ["department.name", "-requests"]
+        }
+
+    Fields are the entity's own whitelisted fields or "join.field" for a
+    whitelisted relation; joins used by a field reference are added
+    automatically. Conditions on an aggregate name filter the groups, and
+    {"any": [...]} ORs its conditions. Report.columns picks and orders the
+    output columns.
+
+    Compiled plans are kept in an LRU cache of CUSTOM_REPORT_PLAN_CACHE_SIZE
+    entries keyed by the spec hash, so repeated previews, counts and runs
+    of the same report skip validation and query building.
+    """
+
+    def __init__(self, max_plans=None):
+        self.max_plans = max_plans
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(self, spec, columns=None):
+        """Return the compiled plan for a spec, compiling it on first use"""
+        digest = spec_digest(spec, columns)
+        with self._lock:
+            plan = self._plans.get(digest)
+            if plan is not None:
+                self._plans.move_to_end(digest)
+                return plan
+
+        plan = self._compile(digest, spec or {}, list(columns or []))
+
+        max_plans = self.max_plans or getattr(settings, 'CUSTOM_REPORT_PLAN_CACHE_SIZE', 256)
+        with self._lock:
+            self._plans[digest] = plan
+            while len(self._plans) > max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def _compile(self, digest, spec, columns):
+        if not isinstance(spec, dict):
+            raise ValueError("Custom report spec must be an object")
+        unknown = set(spec) - {'entity', 'joins', 'where', 'group_by', 'aggregates', 'order_by'}
+        if unknown:
+            raise ValueError(f"Unknown custom report spec key(s): {', '.join(sorted(unknown))}")
+
+        entity_name = spec.get('entity')
+        if entity_name not in ENTITIES:
+            raise ValueError(f"Unknown custom report entity: {entity_name}")
+        entity = ENTITIES[entity_name]
+        joins = set()
+        for join in self._list(spec, 'joins'):
+            self._join(entity_name, entity, join)
+            joins.add(join)
+
+        def resolve(reference):
+            expression, join = self._resolve_field(entity_name, entity, reference)
+            if join:
+                joins.add(join)
+            return expression
+
+        group_by = self._list(spec, 'group_by')
+        aggregates = {}
+        for aggregate in self._list(spec, 'aggregates'):
+            name, expression = self._aggregate(aggregate, resolve)
+            if name in aggregates or name in group_by:
+                raise ValueError(f"Duplicate custom report column: {name}")
+            aggregates[name] = expression
+
+        try:
+            queryset = entity.model.objects.all()
+            where, having = Q(), Q()
+            for condition in self._list(spec, 'where'):
+                q, on_aggregate = self._condition(condition, resolve, aggregates)
+                if on_aggregate:
+                    having &= q
+                else:
+                    where &= q
+            queryset = queryset.filter(where)
+
+            if group_by or aggregates:
+                available = list(group_by) + list(aggregates)
+                fields, expressions = self._select(entity, group_by, resolve)
+                if not group_by:
+                    # Grouping by a constant gives one row of totals. A bare
+                    # Value is left out of GROUP BY, which breaks count()
+                    expressions = {'_all': Cast(Value(1), IntegerField())}
+                queryset = queryset.values(*fields, **expressions).annotate(**aggregates).filter(having)
+                columns = columns or available
+                for column in columns:
+                    if column not in available:
+                        raise ValueError(f"Column {column} must be grouped or aggregated")
+                default_ordering = list(group_by)
+            else:
+                if having:
+                    raise ValueError("Conditions on aggregates need aggregates")
+                columns = columns or list(entity.default_columns)
+                _, expressions = self._select(entity, columns, resolve)
+                # Rows are projected with values_list(), whose joins follow
+                # from the selected paths; select_related keeps the same joins
+                # for callers loading model instances
+                paths = [self._join(entity_name, entity, join)[0] for join in sorted(joins)]
+                queryset = queryset.select_related(*paths).annotate(**expressions)
+                default_ordering = [entity.model._meta.pk.name]
+                available = list(columns) + entity.fields
+
+            ordering = []
+            for column in self._list(spec, 'order_by') or default_ordering:
+                if not isinstance(column, str):
+                    raise ValueError(f"Invalid custom report ordering: {column!r}")
+                name = column[1:] if column.startswith('-') else column
+                if name not in available:
+                    raise ValueError(f"Cannot order by {name}: it is not a column of the report")
+                ordering.append(F(name).desc() if column.startswith('-') else F(name).asc())
+            queryset = queryset.order_by(*ordering)
+        except ValidationError as e:
+            # Raised while building lookups for values of the wrong type
+            raise ValueError(f"Invalid custom report spec: {' '.join(e.messages)}")
+        except (FieldError, TypeError) as e:
+            raise ValueError(f"Invalid custom report spec: {e}")
+
+        models = {entity.model}
+        for join in joins:
+            models.update(self._path_models(entity.model, self._join(entity_name, entity, join)[0]))
+        return CompiledReport(digest, list(columns), queryset, sorted(models, key=lambda model: model._meta.label))
+
+    def _list(self, spec, key):
+        value = spec.get(key) or []
+        if not isinstance(value, list):
+            raise ValueError(f"Custom report spec {key} must be a list")
+        return value
+
+    def _path_models(self, model, path):
+        """Models joined along an ORM relation path"""
+        models = []
+        for name in path.split('__'):
+            model = model._meta.get_field(name).related_model
+            models.append(model)
+        return models
+
+    def _join(self, entity_name, entity, join):
+        if not isinstance(join, str) or join not in entity.joins:
+            raise ValueError(f"Cannot join {join} from {entity_name}")
+        return entity.joins[join]
+
+    def _select(self, entity, references, resolve):
+        """
+        Split selected references into the entity's own fields and named
+        expressions; annotations may not shadow model field names.
+        """
+        fields, expressions = [], {}
+        for reference in references:
+            expression = resolve(reference)
+            if reference in entity.fields:
+                fields.append(reference)
+            else:
+                expressions[reference] = expression
+        return fields, expressions
+
+    def _resolve_field(self, entity_name, entity, reference):
+        """Expression and join used by a "[join.]field[:date_part]" reference"""
+        if not isinstance(reference, str):
+            raise ValueError(f"Invalid custom report field: {reference!r}")
+        field, _, date_part = reference.partition(':')
+        join, _, field = field.rpartition('.')
+
+        path_prefix, target = '', entity
+        if join:
+            path, target_name = self._join(entity_name, entity, join)
+            path_prefix, target = f"{path}__", ENTITIES[target_name]
+        if field not in target.fields:
+            raise ValueError(f"Unknown custom report field: {reference}")
+
+        expression = F(path_prefix + field)
+        if date_part:
+            if date_part not in DATE_PARTS:
+                raise ValueError(f"Unknown date part in {reference}")
+            expression = DATE_PARTS[date_part](path_prefix + field)
+        return expression, join or None
+
+    def _aggregate(self, aggregate, resolve):
+        if not isinstance(aggregate, dict):
+            raise ValueError(f"Invalid custom report aggregate: {aggregate!r}")
+        name = aggregate.get('name')
+        function = aggregate.get('function')
+        if not isinstance(name, str) or not AGGREGATE_NAME_RE.match(name):
+            raise ValueError(f"Invalid aggregate name: {name!r}")
+        if function not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate function: {function}")
+
+        field = aggregate.get('field')
+        if field is None:
+            if function != 'count':
+                raise ValueError(f"Aggregate {name} needs a field")
+            return name, Count('pk', distinct=bool(aggregate.get('distinct')))
+        if function == 'count':
+            return name, Count(resolve(field), distinct=bool(aggregate.get('distinct')))
+        return name, AGGREGATES[function](resolve(field))
+
+    def _condition(self, condition, resolve, aggregates):
+        """Q object for a where condition and whether it applies to aggregates"""
+        if not isinstance(condition, dict):
+            raise ValueError(f"Invalid custom report condition: {condition!r}")
+        if 'any' in condition:
+            parts = [self._condition(part, resolve, aggregates) for part in condition['any'] or []]
+            if not parts:
+                raise ValueError("A condition with any needs at least one condition")
+            if len({on_aggregate for _, on_aggregate in parts}) > 1:
+                raise ValueError("Cannot mix aggregate and field conditions in any")
+            q = Q()
+            for part, _ in parts:
+                q |= part
+            return q, parts[0][1]
+
+        op = condition.get('op', 'eq')
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown condition operator: {op}")
+        lookup, negated = OPERATORS[op]
+        value = condition.get('value')
+        if lookup in ('in', 'range') and not isinstance(value, list):
+            raise ValueError(f"Operator {op} needs a list value")
+        if lookup == 'range' and len(value) != 2:
+            raise ValueError("Operator between needs two values")
+
+        field = condition.get('field')
+        on_aggregate = field in aggregates
+        if on_aggregate:
+            q = Q(**{f"{field}__{lookup}": value})
+        else:
+            expression = resolve(field)
+            if not isinstance(expression, F):
+                raise ValueError(f"Cannot filter on a date part, filter on the field instead: {field}")
+            q = Q(**{f"{expression.name}__{lookup}": value})
+        return (~q if negated else q), on_aggregate
+
+
+custom_report_compiler = CustomReportCompiler()
@@ -0,0 +1,175 @@
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from .models import BlobReader
+
+
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+BYTE_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a Range header into an inclusive (start, end) byte range.
+
+    Returns None when the header should be ignored, which includes
+    multi-range requests: those are answered with the whole file.
+    """
+    match = BYTE_RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    """A Range request only applies while If-Range still matches the file"""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return last_modified is not None and parse_http_date_safe(if_range) == last_modified
+
+
+def read_range(file, start, length):
+    """Yield `length` bytes of an open file starting at `start`"""
+    try:
+        file.seek(start)
+        while length > 0:
+            block = file.read(min(DOWNLOAD_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def serve_file(request, field_file, filename=None, size=None, digest=None, gzipped=False):
+    """
+    Serve a stored file as a download without reading it into memory.
+
+    Supports conditional GET (ETag and Last-Modified) and single byte
+    ranges. With REPORT_DOWNLOAD_SENDFILE set to 'x-sendfile' or
+    'x-accel-redirect', only headers are returned and the front proxy
+    sends the bytes; X-Accel-Redirect paths are the file name under
+    REPORT_DOWNLOAD_ACCEL_PREFIX.
+
+    Gzipped files (report blobs) are sent as stored with Content-Encoding:
+    gzip to clients that accept it, and decompressed on the fly for Range
+    requests and clients that do not. `size` is then the uncompressed size
+    and `digest` a content hash used as the ETag.
+    """
+    name = field_file.name
+    storage = field_file.storage
+    filename = filename or os.path.basename(name)
+    size = field_file.size if size is None else size
+    send_encoded = gzipped and accepts_gzip(request) and not request.headers.get('Range')
+
+    try:
+        modified = storage.get_modified_time(name)
+    except (NotImplementedError, OSError):
+        modified = None
+    last_modified = int(modified.timestamp()) if modified else None
+    etag = digest or hashlib.sha1(f"{name}:{size}:{last_modified}".encode()).hexdigest()
+    # The encoded and decoded representations need distinct validators
+    etag = quote_etag(f"{etag}-gzip" if send_encoded else etag)
+
+    content_type, encoding = mimetypes.guess_type(filename)
+    headers = {
+        'Content-Type': content_type or 'application/octet-stream',
+        'Content-Disposition': content_disposition_header(True, filename),
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if gzipped:
+        headers['Vary'] = 'Accept-Encoding'
+
+    # 304 Not Modified / 412 Precondition Failed
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified, response=HttpResponse(headers=headers)
+    )
+    if response.status_code != 200:
+        return response
+
+    sendfile = getattr(settings, 'REPORT_DOWNLOAD_SENDFILE', None)
+    if sendfile and (send_encoded or not gzipped):
+        if send_encoded:
+            headers['Content-Encoding'] = 'gzip'
+        if sendfile == 'x-sendfile':
+            headers['X-Sendfile'] = storage.path(name)
+            return HttpResponse(headers=headers)
+        if sendfile == 'x-accel-redirect':
+            prefix = getattr(settings, 'REPORT_DOWNLOAD_ACCEL_PREFIX', '/protected/')
+            headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + name.lstrip('/')
+            return HttpResponse(headers=headers)
+
+    if send_encoded:
+        response = FileResponse(storage.open(name, 'rb'), content_type=headers['Content-Type'])
+        for header, value in headers.items():
+            response[header] = value
+        response['Content-Encoding'] = 'gzip'
+        return response
+
+    start, end = 0, size - 1
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except RangeNotSatisfiable:
+            headers['Content-Range'] = f'bytes */{size}'
+            return HttpResponse(status=416, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    if 'Content-Range' not in headers and not gzipped:
+        response = FileResponse(
+            storage.open(name, 'rb'), as_attachment=True, filename=filename,
+            content_type=headers['Content-Type']
+        )
+        for header in ('Accept-Ranges', 'ETag', 'Last-Modified'):
+            if header in headers:
+                response[header] = headers[header]
+        return response
+
+    file = storage.open(name, 'rb')
+    if gzipped:
+        file = BlobReader(file)
+    headers['Content-Length'] = str(end - start + 1)
+    return StreamingHttpResponse(
+        read_range(file, start, end - start + 1),
+        status=206 if 'Content-Range' in headers else 200,
+        headers=headers
+    )
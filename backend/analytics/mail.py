@@ -0,0 +1,51 @@
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+from .utils import chunked
+
+
+class MailDispatcher:
+    """
+    Send many email messages over a few pooled connections.
+
+    Messages go out in batches of MAIL_BATCH_SIZE, each batch through one
+    backend connection with send_messages(), so SMTP sessions are opened
+    once per batch rather than once per message. MAIL_RATE_LIMIT caps the
+    average number of messages sent per second; unset or 0 disables
+    throttling. Any email backend works, including locmem in tests.
+    """
+
+    def __init__(self, batch_size=None, rate_limit=None, backend=None):
+        self.batch_size = batch_size or getattr(settings, 'MAIL_BATCH_SIZE', 100)
+        self.rate_limit = rate_limit if rate_limit is not None else getattr(settings, 'MAIL_RATE_LIMIT', None)
+        self.backend = backend
+        self._next_send = None
+
+    def send(self, messages, on_sent=None):
+        """
+        Send an iterable of EmailMessages and return how many were sent.
+
+        `on_sent` is called with each batch once it has been handed to the
+        backend, so callers can record progress as they go; a failing batch
+        raises and leaves later batches unsent.
+        """
+        sent = 0
+        for batch in chunked(messages, self.batch_size):
+            self._throttle(len(batch))
+            with get_connection(backend=self.backend, fail_silently=False) as connection:
+                sent += connection.send_messages(batch) or 0
+            if on_sent:
+                on_sent(batch)
+        return sent
+
+    def _throttle(self, count):
+        """Wait until sending `count` more messages keeps within the rate limit"""
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        if self._next_send is not None and self._next_send > now:
+            time.sleep(self._next_send - now)
+            now = self._next_send
+        self._next_send = now + count / self.rate_limit
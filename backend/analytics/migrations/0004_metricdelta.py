@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0003_alter_report_columns_alter_report_email_recipients'),
+        ('employees', '0006_employee_account_number_employee_bank_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricDelta',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('change_type', models.CharField(choices=[('join', 'Joined'), ('termination', 'Termination'), ('department_change', 'Department Change'), ('status_change', 'Active Status Change'), ('removal', 'Employee Removed')], max_length=20)),
+                ('effective_date', models.DateField(help_text='First date whose metrics are affected')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('department', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='employees.department')),
+                ('employee', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='metric_deltas', to='employees.employee')),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
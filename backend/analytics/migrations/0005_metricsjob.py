@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_metricdelta'),
+        ('employees', '0006_employee_account_number_employee_bank_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricsJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('total_chunks', models.IntegerField(default=0)),
+                ('completed_chunks', models.IntegerField(default=0)),
+                ('rows_written', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('error_message', models.TextField(blank=True)),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='employees.employee')),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_dataversion'),
+        ('employees', '0006_employee_account_number_employee_bank_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='hrmetric',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='hrmetric',
+            name='granularity',
+            field=models.CharField(choices=[('day', 'Daily'), ('month', 'Monthly'), ('quarter', 'Quarterly'), ('year', 'Yearly')], default='day', help_text='Period the row covers; rollup rows are dated on the first day of their period', max_length=10),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hrmetric',
+            unique_together={('metric_type', 'date', 'department', 'granularity')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0007_alter_hrmetric_unique_together_hrmetric_granularity_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportexecution',
+            name='data_version',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='reportexecution',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0008_reportexecution_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportexecution',
+            name='estimated_rows',
+            field=models.IntegerField(blank=True, help_text='Row count estimated when the execution was queued', null=True),
+        ),
+    ]
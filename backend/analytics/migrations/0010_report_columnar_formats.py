@@ -0,0 +1,24 @@
+# Generated by Django 5.2.1 on 2026-10-16 23:58
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0009_reportexecution_estimated_rows'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='report',
+            name='format',
+            field=models.CharField(choices=[('pdf', 'PDF'), ('excel', 'Excel'), ('csv', 'CSV'), ('parquet', 'Parquet'), ('arrow', 'Arrow IPC')], default='pdf', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='reportexecution',
+            name='file',
+            field=models.FileField(blank=True, null=True, upload_to='reports/%Y/%m/%d/', validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'xlsx', 'csv', 'parquet', 'arrow'])]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-17 01:12
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0012_reportexecution_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportblob',
+            name='last_used_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 00:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0013_reportblob_last_used_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='metricdelta',
+            name='change_type',
+            field=models.CharField(choices=[('join', 'Joined'), ('termination', 'Termination'), ('department_change', 'Department Change'), ('removal', 'Employee Removed')], max_length=20),
+        ),
+    ]
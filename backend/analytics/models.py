@@ -1,9 +1,15 @@
-from django.db import models
+from django.core.files import File
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
 from django.utils import timezone
 from datetime import datetime, timedelta
+import gzip
+import hashlib
 import json
+import os
+import tempfile
 
 from employees.models import Employee
 
@@ -30,6 +36,8 @@ class Report(models.Model):
         ('pdf', 'PDF'),
         ('excel', 'Excel'),
         ('csv', 'CSV'),
+        ('parquet', 'Parquet'),
+        ('arrow', 'Arrow IPC'),
     ]
     
     name = models.CharField(max_length=200)
@@ -61,12 +69,89 @@ class Report(models.Model):
         return self.name
 
 
+class BlobReader(gzip.GzipFile):
+    """Decompressing reader over a stored blob that also closes the storage file"""
+    
+    def __init__(self, fileobj):
+        super().__init__(fileobj=fileobj, mode='rb')
+        self._storage_file = fileobj
+    
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._storage_file.close()
+
+
+class ReportBlob(models.Model):
+    """
+    Gzip-compressed report file, stored once per distinct content.
+    
+    Blobs are addressed by the SHA-256 digest of the uncompressed bytes, so
+    executions that generate identical files share a single stored copy.
+    last_used_at is refreshed whenever store() hands a blob out, and
+    unreferenced blobs are only collected once it is old enough.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='reports/blobs/')
+    size = models.PositiveBigIntegerField(help_text="Uncompressed size in bytes")
+    compressed_size = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return self.digest
+    
+    @classmethod
+    def store(cls, file):
+        """Return the blob holding the contents of a binary file, creating it if needed"""
+        file.seek(0)
+        digest = hashlib.sha256()
+        size = 0
+        compressed = tempfile.TemporaryFile()
+        # A fixed mtime keeps the compressed bytes a pure function of the content
+        with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as gz:
+            for block in iter(lambda: file.read(64 * 1024), b''):
+                digest.update(block)
+                size += len(block)
+                gz.write(block)
+        digest = digest.hexdigest()
+        
+        with compressed:
+            existing = cls.objects.filter(digest=digest).first()
+            # Touching last_used_at keeps the blob from being collected before
+            # the caller saves a reference to it; no row means it just was
+            if existing and cls.objects.filter(pk=existing.pk).update(last_used_at=timezone.now()):
+                existing.refresh_from_db(fields=['last_used_at'])
+                return existing
+            
+            blob = cls(digest=digest, size=size, compressed_size=compressed.tell())
+            compressed.seek(0)
+            blob.file.save(f"{digest[:2]}/{digest}.gz", File(compressed), save=False)
+        
+        try:
+            with transaction.atomic():
+                blob.save()
+        except IntegrityError:
+            # Stored concurrently by another worker
+            blob.file.delete(save=False)
+            existing = cls.objects.get(digest=digest)
+            cls.objects.filter(pk=existing.pk).update(last_used_at=timezone.now())
+            return existing
+        return blob
+    
+    def open(self):
+        """Open the uncompressed contents for reading"""
+        return BlobReader(self.file.storage.open(self.file.name, 'rb'))
+
+
 class ReportExecution(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('running', 'Running'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
     ]
     
     report = models.ForeignKey(Report, on_delete=models.CASCADE, related_name='executions')
@@ -80,18 +165,94 @@ class ReportExecution(models.Model):
         upload_to='reports/%Y/%m/%d/',
         null=True,
         blank=True,
-        validators=[FileExtensionValidator(allowed_extensions=['pdf', 'xlsx', 'csv'])]
+        validators=[FileExtensionValidator(allowed_extensions=['pdf', 'xlsx', 'csv', 'parquet', 'arrow'])]
     )
     
     error_message = models.TextField(blank=True)
     execution_time = models.DurationField(null=True, blank=True)
     record_count = models.IntegerField(null=True, blank=True)
+    estimated_rows = models.IntegerField(null=True, blank=True, help_text="Row count estimated when the execution was queued")
+    
+    # Progress of a running generation
+    generation_started_at = models.DateTimeField(null=True, blank=True)
+    rows_processed = models.IntegerField(default=0)
+    cancel_requested = models.BooleanField(default=False)
+    
+    # Generated output, shared with identical executions
+    blob = models.ForeignKey(ReportBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='executions')
+    filename = models.CharField(max_length=255, blank=True)
+    
+    # Result cache: what was generated and from which version of the data
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+    data_version = models.CharField(max_length=40, blank=True)
     
     class Meta:
         ordering = ['-started_at']
     
     def __str__(self):
         return f"{self.report.name} - {self.started_at.strftime('%Y-%m-%d %H:%M')}"
+    
+    @property
+    def percent_complete(self):
+        if self.status == 'completed':
+            return 100
+        if not self.estimated_rows:
+            return 0
+        # Estimates can be stale, so never report a running execution as done
+        return min(round(self.rows_processed / self.estimated_rows * 100, 2), 99.99)
+    
+    @property
+    def eta(self):
+        """Estimated time until a running execution finishes, from its rate so far"""
+        if self.status != 'running' or not self.rows_processed or not self.estimated_rows:
+            return None
+        elapsed = timezone.now() - self.generation_started_at
+        remaining_rows = max(self.estimated_rows - self.rows_processed, 0)
+        return elapsed * remaining_rows / self.rows_processed
+    
+    @property
+    def has_output(self):
+        return bool(self.blob_id or self.file)
+    
+    @property
+    def output_name(self):
+        """File name the output is downloaded and attached as"""
+        return self.filename or os.path.basename(self.file.name)
+    
+    def open_output(self):
+        """Open the generated file for reading, whether stored as a blob or a plain file"""
+        if self.blob_id:
+            return self.blob.open()
+        return self.file.storage.open(self.file.name, 'rb')
+    
+    def output_filename(self, extension):
+        """Download name for output of this execution's report, stamped with the current time"""
+        return f"{self.report.name}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    
+    def share_output(self, source):
+        """Point this execution at the output of another, identical one"""
+        self.blob = source.blob
+        self.file.name = source.file.name
+        # Identical output may come from a report with another name
+        extension = os.path.splitext(source.output_name)[1].lstrip('.')
+        self.filename = self.output_filename(extension)
+    
+    @classmethod
+    def find_reusable(cls, fingerprint, data_version):
+        """Latest completed execution with the same output whose file still exists"""
+        executions = cls.objects.filter(
+            fingerprint=fingerprint,
+            data_version=data_version,
+            status='completed'
+        ).filter(
+            models.Q(blob__isnull=False) | ~models.Q(file='') & models.Q(file__isnull=False)
+        ).select_related('blob').order_by('-completed_at')
+        
+        for execution in executions[:5]:
+            stored = execution.blob.file if execution.blob_id else execution.file
+            if stored.storage.exists(stored.name):
+                return execution
+        return None
 
 
 class Certificate(models.Model):
@@ -157,14 +318,15 @@ class Certificate(models.Model):
         if self.expiry_date:
             return 0 <= self.days_until_expiry <= self.reminder_days_before
     
-    def update_status(self):
+    def update_status(self, save=True):
         if self.is_expired:
             self.status = 'expired'
         elif self.is_expiring_soon:
             self.status = 'expiring_soon'
         else:
             self.status = 'active'
-        self.save(update_fields=['status'])
+        if save:
+            self.save(update_fields=['status'])
 
 
 class HRMetric(models.Model):
@@ -179,6 +341,13 @@ class HRMetric(models.Model):
         ('promotion_rate', 'Promotion Rate'),
     ]
     
+    GRANULARITY_CHOICES = [
+        ('day', 'Daily'),
+        ('month', 'Monthly'),
+        ('quarter', 'Quarterly'),
+        ('year', 'Yearly'),
+    ]
+    
     metric_type = models.CharField(max_length=50, choices=METRIC_TYPES)
     value = models.DecimalField(max_digits=10, decimal_places=2)
     percentage_value = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
@@ -188,6 +357,10 @@ class HRMetric(models.Model):
     month = models.IntegerField()
     year = models.IntegerField()
     quarter = models.IntegerField()
+    granularity = models.CharField(
+        max_length=10, choices=GRANULARITY_CHOICES, default='day',
+        help_text="Period the row covers; rollup rows are dated on the first day of their period"
+    )
     
     # Dimensional breakdowns
     department = models.ForeignKey('employees.Department', on_delete=models.CASCADE, null=True, blank=True)
@@ -198,8 +371,97 @@ class HRMetric(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
-        unique_together = ['metric_type', 'date', 'department']
+        unique_together = ['metric_type', 'date', 'department', 'granularity']
         ordering = ['-date', 'metric_type']
     
     def __str__(self):
         return f"{self.get_metric_type_display()} - {self.date}"
+
+
+class MetricDelta(models.Model):
+    """A recorded employee change that invalidates stored HR metrics"""
+    CHANGE_TYPES = [
+        ('join', 'Joined'),
+        ('termination', 'Termination'),
+        ('department_change', 'Department Change'),
+        ('removal', 'Employee Removed'),
+    ]
+    
+    employee = models.ForeignKey(Employee, on_delete=models.SET_NULL, null=True, blank=True, related_name='metric_deltas')
+    change_type = models.CharField(max_length=20, choices=CHANGE_TYPES)
+    department = models.ForeignKey('employees.Department', on_delete=models.CASCADE, null=True, blank=True)
+    effective_date = models.DateField(help_text="First date whose metrics are affected")
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+    
+    def __str__(self):
+        return f"{self.get_change_type_display()} - {self.effective_date}"
+
+
+class MetricsJob(models.Model):
+    """A background recalculation of HR metrics over a date range"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    
+    requested_by = models.ForeignKey(Employee, on_delete=models.SET_NULL, null=True, blank=True)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    
+    # Progress
+    total_chunks = models.IntegerField(default=0)
+    completed_chunks = models.IntegerField(default=0)
+    rows_written = models.IntegerField(default=0)
+    
+    started_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    error_message = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['-started_at']
+    
+    def __str__(self):
+        return f"Metrics {self.start_date} - {self.end_date} ({self.status})"
+    
+    @property
+    def percent_complete(self):
+        if not self.total_chunks:
+            return 0
+        return round(self.completed_chunks / self.total_chunks * 100, 2)
+    
+    @property
+    def elapsed(self):
+        return (self.completed_at or timezone.now()) - self.started_at
+
+
+class DataVersion(models.Model):
+    """Change counter for a named slice of data, used to invalidate cached results"""
+    key = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+    
+    @classmethod
+    def bump(cls, *keys):
+        """Increment the version of every given key"""
+        keys = set(keys)
+        if not keys:
+            return
+        cls.objects.bulk_create([cls(key=key) for key in keys], ignore_conflicts=True)
+        cls.objects.filter(key__in=keys).update(version=F('version') + 1, updated_at=timezone.now())
+    
+    @classmethod
+    def current(cls, keys):
+        """Return the current version of each key, 0 for keys never bumped"""
+        versions = dict(cls.objects.filter(key__in=keys).values_list('key', 'version'))
+        return [versions.get(key, 0) for key in keys]
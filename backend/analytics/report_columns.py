@@ -0,0 +1,189 @@
+from collections import namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import (
+    CharField, Count, DecimalField, DurationField, ExpressionWrapper, F, FloatField,
+    IntegerField, OuterRef, Subquery, Value
+)
+from django.db.models.expressions import Col, Ref
+from django.db.models.functions import Cast, Coalesce, Concat, NullIf
+from django.utils import timezone
+from employees.models import EmployeeTimeline
+from leave.models import LeaveRequest
+
+from .models import Certificate
+
+
+# A logical report column: the database expression that selects it, an
+# optional function applied to each fetched value and, when that function
+# changes the type, the model field describing the converted value
+ReportColumn = namedtuple('ReportColumn', ['expression', 'convert', 'output_field'], defaults=[None, None])
+
+
+def days_until(day):
+    """Days from today until `day`, negative once it has passed"""
+    return (day - timezone.now().date()).days if day else None
+
+
+def duration_days(duration):
+    return duration.days if duration is not None else None
+
+
+def termination_reason():
+    """Description, or failing that the title, of an employee's first termination event"""
+    return Subquery(
+        EmployeeTimeline.objects.filter(
+            employee=OuterRef('pk'),
+            event_type='TERM'
+        ).order_by('event_date').annotate(
+            reason=Coalesce(NullIf('description', Value('')), 'title', output_field=CharField())
+        ).values('reason')[:1],
+        output_field=CharField()
+    )
+
+
+def leave_request_count(status):
+    """Number of leave requests with `status` for a balance's employee, leave type and year"""
+    return Coalesce(
+        Subquery(
+            LeaveRequest.objects.filter(
+                employee=OuterRef('employee'),
+                leave_type=OuterRef('leave_type'),
+                start_date__year=OuterRef('year'),
+                status=status
+            ).order_by().values('employee').annotate(count=Count('pk')).values('count'),
+            output_field=IntegerField()
+        ),
+        Value(0)
+    )
+
+
+# Digits of computed decimal columns, the most a 128-bit decimal holds
+WIDE_DECIMAL_DIGITS = 38
+
+CERTIFICATE_TYPE_LABELS = dict(Certificate.CERTIFICATE_TYPES)
+
+REPORT_COLUMNS = {
+    'headcount': {
+        'employee_id': ReportColumn(F('employee_id')),
+        'full_name': ReportColumn(Concat('first_name', Value(' '), 'last_name')),
+        'department': ReportColumn(F('department__name')),
+        'designation': ReportColumn(F('designation__title')),
+        'hire_date': ReportColumn(F('date_of_joining')),
+        'status': ReportColumn(F('is_active')),
+    },
+    'certificate_expiry': {
+        'employee_id': ReportColumn(F('employee_id')),
+        'employee_name': ReportColumn(Concat('employee__first_name', Value(' '), 'employee__last_name')),
+        'certificate_name': ReportColumn(F('name')),
+        'certificate_type': ReportColumn(F('certificate_type'), CERTIFICATE_TYPE_LABELS.get, CharField()),
+        'expiry_date': ReportColumn(F('expiry_date')),
+        'days_until_expiry': ReportColumn(F('expiry_date'), days_until, IntegerField()),
+    },
+    # Attrition queries are annotated with termination_date by the report builder
+    'attrition': {
+        'employee_id': ReportColumn(F('employee_id')),
+        'full_name': ReportColumn(Concat('first_name', Value(' '), 'last_name')),
+        'department': ReportColumn(F('department__name')),
+        'designation': ReportColumn(F('designation__title')),
+        'hire_date': ReportColumn(F('date_of_joining')),
+        'termination_date': ReportColumn(F('termination_date')),
+        'reason': ReportColumn(termination_reason()),
+        'tenure_days': ReportColumn(
+            ExpressionWrapper(F('termination_date') - F('date_of_joining'), output_field=DurationField()),
+            duration_days,
+            IntegerField()
+        ),
+    },
+    'leave_utilization': {
+        'employee_id': ReportColumn(F('employee_id')),
+        'full_name': ReportColumn(Concat('employee__first_name', Value(' '), 'employee__last_name')),
+        'department': ReportColumn(F('employee__department__name')),
+        'leave_type': ReportColumn(F('leave_type__name')),
+        'year': ReportColumn(F('year')),
+        'total_days': ReportColumn(F('total_days')),
+        'carried_forward_days': ReportColumn(F('carried_forward_days')),
+        'used_days': ReportColumn(F('used_days')),
+        'pending_days': ReportColumn(F('pending_days')),
+        'balance': ReportColumn(ExpressionWrapper(
+            F('total_days') - F('used_days') - F('pending_days'),
+            output_field=DecimalField(max_digits=6, decimal_places=1)
+        )),
+        'utilization_rate': ReportColumn(ExpressionWrapper(
+            Cast('used_days', FloatField()) * Value(100.0) / NullIf(Cast('total_days', FloatField()), Value(0.0)),
+            output_field=FloatField()
+        )),
+        'approved_requests': ReportColumn(leave_request_count('APPROVED')),
+        'pending_requests': ReportColumn(leave_request_count('PENDING')),
+    },
+}
+
+
+def get_report_column(report_type, queryset, column):
+    """
+    Look up a logical column of a report.
+
+    Columns that are not registered fall back to an annotation of the
+    queryset (custom reports annotate every computed column) or a concrete
+    field of the report's model with the same name.
+    """
+    registered = REPORT_COLUMNS.get(report_type, {})
+    if column in registered:
+        return registered[column]
+    if column in queryset.query.annotations:
+        return ReportColumn(F(column))
+
+    try:
+        field = queryset.model._meta.get_field(column)
+    except FieldDoesNotExist:
+        field = None
+    if field is None or not field.concrete or field.is_relation:
+        raise ValueError(f"Unknown column for {report_type} report: {column}")
+    return ReportColumn(F(field.attname))
+
+
+def report_column_fields(report_type, queryset, columns):
+    """Model fields describing the values of each requested column, used to type columnar output"""
+    query = queryset.query.chain()
+    fields = []
+    for column in columns:
+        report_column = get_report_column(report_type, queryset, column)
+        if report_column.output_field is not None:
+            fields.append(report_column.output_field)
+        else:
+            resolved = report_column.expression.resolve_expression(query, allow_joins=True, reuse=None)
+            field = resolved.output_field
+            if isinstance(resolved, Ref):
+                resolved = resolved.source
+            if field.get_internal_type() == 'DecimalField' and not isinstance(resolved, Col):
+                # Sums and arithmetic can outgrow the digits of their source field
+                field = DecimalField(max_digits=WIDE_DECIMAL_DIGITS, decimal_places=field.decimal_places)
+            fields.append(field)
+    return fields
+
+
+def project_report_rows(report_type, queryset, columns, chunk_size=2000):
+    """
+    Select only the requested columns of a report queryset.
+
+    All columns are fetched by one values_list() query and returned as an
+    iterator of dicts keyed by column name. Columns are resolved up front so
+    unknown names fail before any rows are read.
+    """
+    report_columns = [get_report_column(report_type, queryset, column) for column in columns]
+    expressions = [report_column.expression for report_column in report_columns]
+    converters = [
+        (index, report_column.convert)
+        for index, report_column in enumerate(report_columns)
+        if report_column.convert
+    ]
+
+    def rows():
+        for values in queryset.values_list(*expressions).iterator(chunk_size=chunk_size):
+            if converters:
+                values = list(values)
+                for index, convert in converters:
+                    values[index] = convert(values[index])
+            yield dict(zip(columns, values))
+
+    return rows()
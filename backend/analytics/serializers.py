@@ -1,5 +1,7 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Report, ReportExecution, Certificate, HRMetric
+from .custom_reports import custom_report_compiler
+from .models import Report, ReportExecution, Certificate, HRMetric, MetricsJob
 
 
 class ReportSerializer(serializers.ModelSerializer):
@@ -12,6 +14,17 @@ class ReportSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ['created_by', 'created_at', 'updated_at']
     
+    def validate(self, attrs):
+        report_type = attrs.get('report_type', getattr(self.instance, 'report_type', None))
+        if report_type == 'custom':
+            filters = attrs.get('filters', getattr(self.instance, 'filters', {}))
+            columns = attrs.get('columns', getattr(self.instance, 'columns', []))
+            try:
+                custom_report_compiler.compile(filters, columns)
+            except ValueError as e:
+                raise serializers.ValidationError({'filters': str(e)})
+        return attrs
+    
     def get_execution_count(self, obj):
         return obj.executions.count()
     
@@ -31,13 +44,25 @@ class ReportExecutionSerializer(serializers.ModelSerializer):
     report_name = serializers.CharField(source='report.name', read_only=True)
     executed_by_name = serializers.CharField(source='executed_by.get_full_name', read_only=True)
     file_url = serializers.SerializerMethodField()
+    percent_complete = serializers.ReadOnlyField()
+    eta_seconds = serializers.SerializerMethodField()
     
     class Meta:
         model = ReportExecution
         fields = '__all__'
-        read_only_fields = ['executed_by', 'started_at', 'completed_at', 'execution_time']
+        read_only_fields = ['executed_by', 'started_at', 'completed_at', 'execution_time',
+                            'generation_started_at', 'rows_processed', 'cancel_requested']
+    
+    def get_eta_seconds(self, obj):
+        eta = obj.eta
+        return round(eta.total_seconds(), 2) if eta is not None else None
     
     def get_file_url(self, obj):
+        if obj.blob_id:
+            # Blobs are stored compressed; they are served through the download action
+            url = reverse('analytics:reportexecution-download', args=[obj.pk])
+            request = self.context.get('request')
+            return request.build_absolute_uri(url) if request else url
         if obj.file:
             return obj.file.url
         return None
@@ -63,4 +88,18 @@ class HRMetricSerializer(serializers.ModelSerializer):
     class Meta:
         model = HRMetric
         fields = '__all__'
-        read_only_fields = ['created_at']
\ No newline at end of file
+        read_only_fields = ['created_at']
+
+
+class MetricsJobSerializer(serializers.ModelSerializer):
+    percent_complete = serializers.ReadOnlyField()
+    elapsed_seconds = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = MetricsJob
+        fields = '__all__'
+        read_only_fields = ['requested_by', 'status', 'total_chunks', 'completed_chunks',
+                            'rows_written', 'started_at', 'completed_at', 'error_message']
+    
+    def get_elapsed_seconds(self, obj):
+        return round(obj.elapsed.total_seconds(), 2)
@@ -1,22 +1,117 @@
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
-from django.utils import timezone
-from .models import Certificate
+from employees.models import Employee, EmployeeTimeline
+from .models import Certificate, HRMetric, MetricDelta, DataVersion
+from .utils import REPORT_SOURCES, bump_hr_metric_versions, table_version_key
 
 
 @receiver(pre_save, sender=Certificate)
 def update_certificate_status(sender, instance, **kwargs):
     """Update certificate status before saving"""
     if instance.expiry_date:
-        instance.update_status()
-
-
-@receiver(post_save, sender=Certificate)
-def schedule_certificate_reminder(sender, instance, created, **kwargs):
-    """Schedule reminder for new certificates"""
-    if created and instance.expiry_date:
-        from .tasks import send_certificate_reminders
-        # Check if reminder should be sent soon
-        days_until_expiry = instance.days_until_expiry
-        if 0 <= days_until_expiry <= instance.reminder_days_before:
-            send_certificate_reminders.delay(instance.reminder_days_before)
\ No newline at end of file
+        instance.update_status(save=False)
+
+
+def record_metric_delta(employee, change_type, department_id, effective_date):
+    """Record a metric-affecting change and queue the incremental update"""
+    MetricDelta.objects.create(
+        employee=employee,
+        change_type=change_type,
+        department_id=department_id,
+        effective_date=effective_date
+    )
+
+    from .tasks import apply_metric_deltas
+    transaction.on_commit(apply_metric_deltas.delay)
+
+
+@receiver(pre_save, sender=Employee)
+def snapshot_employee_metrics_fields(sender, instance, **kwargs):
+    """Remember the metric-relevant fields of an employee before it changes"""
+    instance._metric_snapshot = None
+    if not instance._state.adding:
+        instance._metric_snapshot = Employee.objects.filter(pk=instance.pk).values(
+            'department_id', 'date_of_joining'
+        ).first()
+
+
+@receiver(post_save, sender=Employee)
+def record_employee_metric_deltas(sender, instance, created, **kwargs):
+    """Record joins and department moves"""
+    old = getattr(instance, '_metric_snapshot', None)
+    if created or old is None:
+        record_metric_delta(instance, 'join', instance.department_id, instance.date_of_joining)
+        return
+
+    if old['date_of_joining'] != instance.date_of_joining:
+        record_metric_delta(
+            instance, 'join', instance.department_id,
+            min(old['date_of_joining'], instance.date_of_joining)
+        )
+
+    if old['department_id'] != instance.department_id:
+        # Metrics attribute employees to their current department for their
+        # whole tenure, so a move rewrites both departments since joining
+        since = min(old['date_of_joining'], instance.date_of_joining)
+        record_metric_delta(instance, 'department_change', old['department_id'], since)
+        record_metric_delta(instance, 'department_change', instance.department_id, since)
+
+
+@receiver(post_delete, sender=Employee)
+def record_employee_removal(sender, instance, **kwargs):
+    """Removing an employee changes every metric since they joined"""
+    record_metric_delta(None, 'removal', instance.department_id, instance.date_of_joining)
+
+
+@receiver(pre_save, sender=EmployeeTimeline)
+def snapshot_termination_date(sender, instance, **kwargs):
+    """Remember the previous date of a termination event"""
+    instance._previous_event = None
+    if not instance._state.adding:
+        instance._previous_event = EmployeeTimeline.objects.filter(pk=instance.pk).values(
+            'event_type', 'event_date'
+        ).first()
+
+
+@receiver(post_save, sender=EmployeeTimeline)
+def record_termination_delta(sender, instance, **kwargs):
+    """Record terminations, including edits to an existing termination event"""
+    previous = getattr(instance, '_previous_event', None)
+    dates = []
+    if instance.event_type == 'TERM':
+        dates.append(instance.event_date)
+    if previous and previous['event_type'] == 'TERM':
+        dates.append(previous['event_date'])
+
+    if dates:
+        employee = instance.employee
+        record_metric_delta(employee, 'termination', employee.department_id, min(dates))
+
+
+@receiver(post_delete, sender=EmployeeTimeline)
+def record_termination_removal(sender, instance, **kwargs):
+    """Undoing a termination changes metrics from the old termination date"""
+    if instance.event_type == 'TERM':
+        # Not linked to the employee, which may be mid-deletion itself
+        department_id = Employee.objects.filter(pk=instance.employee_id).values_list(
+            'department_id', flat=True
+        ).first()
+        record_metric_delta(None, 'termination', department_id, instance.event_date)
+
+
+@receiver(post_save, sender=HRMetric)
+@receiver(post_delete, sender=HRMetric)
+def bump_hr_metric_version(sender, instance, **kwargs):
+    """Invalidate cached views over the month of a changed metric"""
+    bump_hr_metric_versions([instance.date])
+
+
+def bump_table_version(sender, **kwargs):
+    """Invalidate cached report results that read the changed table"""
+    DataVersion.bump(table_version_key(sender))
+
+
+for model in {model for models in REPORT_SOURCES.values() for model in models}:
+    post_save.connect(bump_table_version, sender=model, dispatch_uid=f"bump_table_version_save:{model._meta.label_lower}")
+    post_delete.connect(bump_table_version, sender=model, dispatch_uid=f"bump_table_version_delete:{model._meta.label_lower}")
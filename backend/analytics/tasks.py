@@ -1,141 +1,299 @@
 from celery import shared_task
-from django.core.mail import send_mail
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.core.mail import EmailMessage
 from django.template.loader import render_to_string
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, ProtectedError
 from django.utils import timezone
-from datetime import timedelta
-from .models import ReportExecution, Certificate
-from .utils import ReportGenerator
+from datetime import date, timedelta
+from .mail import MailDispatcher
+from .models import ReportExecution, ReportBlob, Certificate, MetricsJob, DataVersion
+from .utils import ReportGenerator, MetricsCalculator, report_data_version, report_fingerprint, table_version_key
 import logging
+import mimetypes
 
 logger = logging.getLogger(__name__)
 
+# Runs metrics jobs in-process when there is no Celery worker to send them to
+_local_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class ReportCancelled(Exception):
+    """Raised inside report generation once a cancel has been requested"""
+
+
+def track_report_progress(execution_id, rows, every):
+    """
+    Pass report rows through, recording progress every `every` rows.
+    
+    Each checkpoint also checks the execution's cancellation flag and
+    raises ReportCancelled when it has been set.
+    """
+    rows_processed = 0
+    for row in rows:
+        yield row
+        rows_processed += 1
+        if rows_processed % every == 0:
+            ReportExecution.objects.filter(id=execution_id).update(rows_processed=rows_processed)
+            if ReportExecution.objects.filter(id=execution_id, cancel_requested=True).exists():
+                raise ReportCancelled
+    
+    ReportExecution.objects.filter(id=execution_id).update(rows_processed=rows_processed)
+
+
+def live_executions(execution_ids):
+    """Executions among `execution_ids` that have not been cancelled"""
+    return ReportExecution.objects.filter(id__in=execution_ids, cancel_requested=False).exclude(status='cancelled')
+
 
 @shared_task
-def generate_report_task(execution_id):
-    """Celery task to generate report files"""
+def generate_report_task(execution_id, duplicate_execution_ids=()):
+    """
+    Celery task to generate report files.
+    
+    Rows are processed in chunks; progress is saved and the cancellation
+    flag checked between chunks. Executions listed in
+    duplicate_execution_ids are for reports with the same fingerprint;
+    they are completed with the file generated here.
+    """
     try:
         execution = ReportExecution.objects.get(id=execution_id)
+        if execution.cancel_requested:
+            raise ReportCancelled
+        
         execution.status = 'running'
-        execution.save()
+        execution.generation_started_at = timezone.now()
+        execution.rows_processed = 0
+        update_fields = ['status', 'generation_started_at', 'rows_processed']
         
         generator = ReportGenerator()
-        report_data = generator.get_report_data(execution.report)
+        report = execution.report
+        if execution.estimated_rows is None:
+            execution.estimated_rows = generator.count_report_rows(report)
+            update_fields.append('estimated_rows')
+        # Leave cancel_requested alone: a cancel may already be on its way
+        execution.save(update_fields=update_fields)
+        
+        columns, rows = generator.get_report_rows(report)
+        rows = track_report_progress(execution.id, rows, generator.chunk_size)
         
         # Generate file based on format
-        if execution.report.format == 'pdf':
-            file_buffer = generator.generate_pdf(report_data, execution.report.name)
-            filename = f"{execution.report.name}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        elif execution.report.format == 'excel':
-            file_buffer = generator.generate_excel(report_data, execution.report.name)
-            filename = f"{execution.report.name}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        if report.format == 'pdf':
+            file_buffer, record_count = generator.generate_pdf(columns, rows, report.name)
+            extension = 'pdf'
+        elif report.format == 'excel':
+            file_buffer, record_count = generator.generate_excel(columns, rows, report.name)
+            extension = 'xlsx'
+        elif report.format in ('parquet', 'arrow'):
+            fields = generator.get_report_fields(report)
+            file_buffer, record_count = generator.generate_columnar(columns, rows, fields, report.format)
+            extension = report.format
         else:  # csv
-            import csv
-            import io
-            file_buffer = io.StringIO()
-            writer = csv.DictWriter(file_buffer, fieldnames=report_data['columns'])
-            writer.writeheader()
-            writer.writerows(report_data['data'])
-            file_buffer.seek(0)
-            filename = f"{execution.report.name}_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        
-        # Save file
-        execution.file.save(filename, file_buffer, save=False)
+            file_buffer, record_count = generator.generate_csv(columns, rows)
+            extension = 'csv'
+        
+        # Store the file once per distinct content
+        with file_buffer:
+            execution.blob = ReportBlob.store(file_buffer)
+        execution.filename = execution.output_filename(extension)
         execution.status = 'completed'
         execution.completed_at = timezone.now()
-        execution.record_count = report_data['total_records']
+        execution.record_count = record_count
+        execution.rows_processed = record_count
         execution.execution_time = execution.completed_at - execution.started_at
         execution.save()
         
-        # Send email if recipients specified
-        if execution.report.email_recipients:
-            send_report_email.delay(execution.id)
+        # Email every completed execution with recipients in one task
+        notify = [execution.id] if report.email_recipients else []
+        for duplicate in live_executions(duplicate_execution_ids).select_related('report'):
+            complete_from_execution(duplicate, execution, notify=False)
+            if duplicate.report.email_recipients:
+                notify.append(duplicate.id)
+        if notify:
+            send_report_email.delay(*notify)
         
         logger.info(f"Report generation completed for execution {execution_id}")
         
+    except ReportCancelled:
+        ReportExecution.objects.filter(id=execution_id).update(
+            status='cancelled',
+            completed_at=timezone.now()
+        )
+        
+        # Identical executions for other reports still need the file
+        duplicates = list(live_executions(duplicate_execution_ids))
+        if duplicates:
+            queue_report_generation(duplicates[0], [duplicate.id for duplicate in duplicates[1:]], scheduled=True)
+        
+        logger.info(f"Report generation cancelled for execution {execution_id}")
+        
     except Exception as e:
-        execution = ReportExecution.objects.get(id=execution_id)
-        execution.status = 'failed'
-        execution.error_message = str(e)
-        execution.completed_at = timezone.now()
-        execution.save()
+        failed = ReportExecution.objects.filter(id=execution_id) | live_executions(duplicate_execution_ids)
+        for execution in failed:
+            execution.status = 'failed'
+            execution.error_message = str(e)
+            execution.completed_at = timezone.now()
+            execution.save()
         
         logger.error(f"Report generation failed for execution {execution_id}: {str(e)}")
 
 
+def complete_from_execution(execution, source, notify=True):
+    """
+    Complete an execution with the file of an identical, completed one.
+    
+    With `notify` false the caller sends the report email, so executions
+    completed together can share one.
+    """
+    execution.share_output(source)
+    execution.status = 'completed'
+    execution.completed_at = timezone.now()
+    execution.record_count = source.record_count
+    execution.execution_time = execution.completed_at - execution.started_at
+    execution.save()
+    
+    if notify and execution.report.email_recipients:
+        send_report_email.delay(execution.id)
+
+
+def queue_report_generation(execution, duplicate_execution_ids=(), scheduled=False):
+    """
+    Estimate the size of an execution and queue its generation.
+    
+    Reports estimated at or above REPORT_HEAVY_ROWS for their format go to
+    the heavy queue; the rest go to the scheduled or interactive queue.
+    """
+    report = execution.report
+    try:
+        execution.estimated_rows = ReportGenerator().count_report_rows(report)
+    except Exception as e:
+        logger.warning(f"Could not estimate size of execution {execution.id}: {str(e)}")
+    else:
+        execution.save(update_fields=['estimated_rows'])
+    
+    heavy_rows = getattr(settings, 'REPORT_HEAVY_ROWS', {}).get(report.format)
+    if heavy_rows is not None and execution.estimated_rows is not None and execution.estimated_rows >= heavy_rows:
+        queue = 'heavy'
+    elif scheduled:
+        queue = 'scheduled'
+    else:
+        queue = 'interactive'
+    
+    generate_report_task.apply_async((execution.id, list(duplicate_execution_ids)), queue=queue)
+    return queue
+
+
 @shared_task
-def send_report_email(execution_id):
-    """Send generated report via email"""
+def send_report_email(*execution_ids):
+    """Send generated reports via email, one message per execution over pooled connections"""
+    executions = ReportExecution.objects.filter(id__in=execution_ids).select_related('report', 'blob')
+    attachments = {}
+    
+    def messages():
+        for execution in executions:
+            if not execution.has_output or not execution.report.email_recipients:
+                continue
+            try:
+                message = render_to_string('analytics/report_email.html', {
+                    'report': execution.report,
+                    'execution': execution,
+                })
+                # Executions sharing a blob attach the same bytes
+                key = execution.blob_id or execution.file.name
+                if key not in attachments:
+                    with execution.open_output() as output:
+                        attachments[key] = output.read()
+            except Exception as e:
+                logger.error(f"Failed to prepare report email for execution {execution.id}: {str(e)}")
+                continue
+            
+            email = EmailMessage(
+                subject=f"Report: {execution.report.name}",
+                body=message,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=execution.report.email_recipients,
+            )
+            email.content_subtype = 'html'
+            email.attach(execution.output_name, attachments[key], mimetypes.guess_type(execution.output_name)[0])
+            yield email
+    
     try:
-        execution = ReportExecution.objects.get(id=execution_id)
-        
-        if not execution.file:
-            return
-        
-        subject = f"Report: {execution.report.name}"
-        message = render_to_string('analytics/report_email.html', {
-            'report': execution.report,
-            'execution': execution,
-        })
-        
-        # Send email with attachment
-        from django.core.mail import EmailMessage
-        
-        email = EmailMessage(
-            subject=subject,
-            body=message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=execution.report.email_recipients,
-        )
-        email.content_subtype = 'html'
-        email.attach_file(execution.file.path)
-        email.send()
-        
-        logger.info(f"Report email sent for execution {execution_id}")
-        
+        sent = MailDispatcher().send(messages())
+        logger.info(f"Report emails sent for {sent} of {len(execution_ids)} executions")
     except Exception as e:
-        logger.error(f"Failed to send report email for execution {execution_id}: {str(e)}")
+        logger.error(f"Failed to send report emails for executions {list(execution_ids)}: {str(e)}")
 
 
 @shared_task
 def send_certificate_reminders(days_before=30):
-    """Send certificate expiry reminders"""
+    """
+    Send certificate expiry reminders as per-recipient digests.
+    
+    Each employee gets one email listing all of their expiring
+    certificates and HR_EMAIL, if set, one email listing every
+    certificate. Reminders are marked sent as each batch of employee
+    digests goes out.
+    """
     try:
-        cutoff_date = timezone.now().date() + timedelta(days=days_before)
+        today = timezone.now().date()
+        cutoff_date = today + timedelta(days=days_before)
         
         certificates = Certificate.objects.filter(
             expiry_date__lte=cutoff_date,
-            expiry_date__gte=timezone.now().date(),
+            expiry_date__gte=today,
             reminder_sent=False
-        )
+        ).select_related('employee').order_by('employee_id', 'expiry_date')
         
+        by_employee = defaultdict(list)
         for cert in certificates:
-            subject = f"Certificate Expiry Reminder: {cert.name}"
-            message = render_to_string('analytics/certificate_reminder_email.html', {
-                'certificate': cert,
-                'employee': cert.employee,
-            })
-            
-            # Send to employee and HR
-            recipients = [cert.employee.email]
-            if hasattr(settings, 'HR_EMAIL'):
-                recipients.append(settings.HR_EMAIL)
-            
-            send_mail(
+            by_employee[cert.employee].append(cert)
+        if not by_employee:
+            logger.info("No certificate reminders to send")
+            return
+        
+        def digest(recipient, employee, certs):
+            subject = (
+                f"Certificate Expiry Reminder: {certs[0].name}" if len(certs) == 1
+                else f"Certificate Expiry Reminder: {len(certs)} certificates"
+            )
+            email = EmailMessage(
                 subject=subject,
-                message='',
-                html_message=message,
+                body=render_to_string('analytics/certificate_reminder_digest_email.html', {
+                    'employee': employee,
+                    'certificates': certs,
+                    'days_before': days_before,
+                }),
                 from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=recipients,
-                fail_silently=False,
+                to=[recipient],
             )
-            
-            # Mark reminder as sent
-            cert.reminder_sent = True
-            cert.reminder_sent_date = timezone.now()
-            cert.save()
+            email.content_subtype = 'html'
+            email.certificate_ids = [cert.id for cert in certs]
+            return email
+        
+        def mark_sent(batch):
+            Certificate.objects.filter(
+                id__in=[cert_id for email in batch for cert_id in email.certificate_ids]
+            ).update(reminder_sent=True, reminder_sent_date=timezone.now())
+            # update() skips the save signals that invalidate cached reports
+            DataVersion.bump(table_version_key(Certificate))
         
-        logger.info(f"Certificate reminders sent for {certificates.count()} certificates")
+        dispatcher = MailDispatcher()
+        sent = dispatcher.send(
+            (digest(employee.email, employee, certs) for employee, certs in by_employee.items()),
+            on_sent=mark_sent
+        )
+        
+        hr_email = getattr(settings, 'HR_EMAIL', None)
+        if hr_email:
+            all_certificates = [cert for certs in by_employee.values() for cert in certs]
+            sent += dispatcher.send([digest(hr_email, None, all_certificates)])
+        
+        logger.info(
+            f"Certificate reminders sent for {sum(len(certs) for certs in by_employee.values())} "
+            f"certificates in {sent} emails"
+        )
         
     except Exception as e:
         logger.error(f"Failed to send certificate reminders: {str(e)}")
@@ -160,6 +318,126 @@ def update_certificate_statuses():
         logger.error(f"Failed to update certificate statuses: {str(e)}")
 
 
+@shared_task
+def collect_report_blobs(grace_hours=24):
+    """
+    Delete stored report blobs that no execution references.
+    
+    Blobs handed out by ReportBlob.store() within the last grace_hours are
+    kept, so a blob stored or reused just before its execution is saved is
+    not collected in between.
+    """
+    try:
+        cutoff = timezone.now() - timedelta(hours=grace_hours)
+        unreferenced = ReportBlob.objects.filter(executions__isnull=True, last_used_at__lt=cutoff)
+        
+        deleted_count = 0
+        freed_bytes = 0
+        for blob_id in unreferenced.values_list('pk', flat=True).iterator():
+            try:
+                with transaction.atomic():
+                    # Re-checked under a row lock: store() touches last_used_at
+                    # with an UPDATE, so a blob it reuses meanwhile either
+                    # waits for this delete and is stored afresh, or is skipped
+                    blob = unreferenced.select_for_update(of=('self',)).filter(pk=blob_id).first()
+                    if blob is None:
+                        continue
+                    blob.delete()
+            except ProtectedError:
+                # Picked up by an execution since the query ran
+                continue
+            blob.file.delete(save=False)
+            deleted_count += 1
+            freed_bytes += blob.compressed_size
+        
+        logger.info(f"Collected {deleted_count} unreferenced report blobs ({freed_bytes} bytes)")
+        
+    except Exception as e:
+        logger.error(f"Failed to collect report blobs: {str(e)}")
+
+
+@shared_task
+def apply_metric_deltas():
+    """Adjust stored HR metrics for recorded employee changes"""
+    try:
+        applied = MetricsCalculator().apply_pending_deltas()
+        if applied:
+            logger.info(f"Applied {applied} metric deltas")
+        
+    except Exception as e:
+        logger.error(f"Failed to apply metric deltas: {str(e)}")
+
+
+def start_metrics_job(job):
+    """Split a metrics job into date chunks and queue them for calculation"""
+    chunk_days = getattr(settings, 'HR_METRICS_CHUNK_DAYS', 31)
+    
+    chunks = []
+    chunk_start = job.start_date
+    while chunk_start <= job.end_date:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), job.end_date)
+        chunks.append((chunk_start.isoformat(), chunk_end.isoformat()))
+        chunk_start = chunk_end + timedelta(days=1)
+    
+    job.total_chunks = len(chunks)
+    job.status = 'running'
+    job.save(update_fields=['total_chunks', 'status'])
+    
+    if getattr(settings, 'CELERY_BROKER_URL', None) and not getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+        for chunk_start, chunk_end in chunks:
+            calculate_metrics_chunk.delay(job.id, chunk_start, chunk_end)
+    else:
+        _local_executor.submit(_run_metrics_chunks, job.id, chunks)
+
+
+def _run_metrics_chunks(job_id, chunks):
+    """Run the chunks of a metrics job one after another in this thread"""
+    try:
+        for chunk_start, chunk_end in chunks:
+            calculate_metrics_chunk.apply(args=(job_id, chunk_start, chunk_end))
+    finally:
+        connection.close()
+
+
+@shared_task
+def calculate_metrics_chunk(job_id, start_date, end_date):
+    """Calculate HR metrics for one date chunk of a MetricsJob"""
+    jobs = MetricsJob.objects.filter(pk=job_id)
+    if jobs.filter(status='failed').exists():
+        return
+    
+    try:
+        # Only daily rows here: chunks are not aligned to months and run
+        # concurrently, so rollups wait until every chunk has committed
+        calculator = MetricsCalculator()
+        with transaction.atomic():
+            calculator.compute_metrics(date.fromisoformat(start_date), date.fromisoformat(end_date))
+            calculator.writer.flush()
+        
+        jobs.update(
+            completed_chunks=F('completed_chunks') + 1,
+            rows_written=F('rows_written') + calculator.writer.rows_written
+        )
+        
+        # The chunk that completes the job rolls up its whole range once
+        with transaction.atomic():
+            if jobs.filter(status='running', completed_chunks=F('total_chunks')).update(
+                status='completed',
+                completed_at=timezone.now()
+            ):
+                job = jobs.get()
+                calculator = MetricsCalculator()
+                calculator.refresh_rollups(job.start_date, job.end_date)
+                jobs.update(rows_written=F('rows_written') + calculator.writer.rows_written)
+        
+        logger.info(f"Metrics job {job_id} calculated {start_date} to {end_date}")
+        
+    except Exception as e:
+        jobs.update(status='failed', error_message=str(e), completed_at=timezone.now())
+        
+        logger.error(f"Metrics job {job_id} failed for {start_date} to {end_date}: {str(e)}")
+
+
 @shared_task
 def generate_scheduled_reports():
     """Generate scheduled reports that are due"""
@@ -173,21 +451,50 @@ def generate_scheduled_reports():
             next_run__lte=now
         )
         
+        # Reports with the same fingerprint produce the same file, so each
+        # distinct file is generated once and shared by all of them
+        groups = defaultdict(list)
         for report in due_reports:
-            # Create execution
-            execution = ReportExecution.objects.create(
-                report=report,
-                status='pending'
-            )
+            groups[report_fingerprint(report)].append(report)
+        
+        for fingerprint, reports in groups.items():
+            data_version = report_data_version(reports[0])
+            
+            # Create executions
+            executions = [
+                ReportExecution.objects.create(
+                    report=report,
+                    status='pending',
+                    fingerprint=fingerprint,
+                    data_version=data_version
+                )
+                for report in reports
+            ]
             
-            # Queue generation task
-            generate_report_task.delay(execution.id)
+            previous = ReportExecution.find_reusable(fingerprint, data_version)
+            if previous:
+                for execution in executions:
+                    complete_from_execution(execution, previous, notify=False)
+                notify = [execution.id for execution in executions if execution.report.email_recipients]
+                if notify:
+                    send_report_email.delay(*notify)
+            else:
+                # Queue generation task
+                queue_report_generation(
+                    executions[0],
+                    [execution.id for execution in executions[1:]],
+                    scheduled=True
+                )
             
             # Update next run time
-            report.next_run = calculate_next_run_time(report.frequency, now)
-            report.save()
+            for report in reports:
+                report.next_run = calculate_next_run_time(report.frequency, now)
+                report.save()
         
-        logger.info(f"Queued {due_reports.count()} scheduled reports")
+        logger.info(
+            f"Queued {sum(len(reports) for reports in groups.values())} scheduled reports "
+            f"as {len(groups)} distinct files"
+        )
         
     except Exception as e:
         logger.error(f"Failed to process scheduled reports: {str(e)}")
@@ -1,3 +1,410 @@
-from django.test import TestCase
+import glob
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timezone as dt_timezone
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import openpyxl
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.test import RequestFactory, TestCase, override_settings
+from employees.models import Department, Designation, Employee, EmployeeTimeline
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF page counts need pypdf
+    PdfReader = None
+
+from . import utils
+from .custom_reports import CustomReportCompiler
+from .downloads import RangeNotSatisfiable, parse_byte_range, serve_file
+from .models import HRMetric, Report, ReportExecution
+from .tasks import generate_report_task
+from .utils import HRMetricWriter, MetricsCalculator, ReportGenerator, active_employees, headcount_series
+
+
+def create_employee(username, department, date_of_joining, termination_date=None):
+    """Create an employee, with a termination event if a date is given"""
+    employee = Employee.objects.create(
+        user=User.objects.create_user(username=username),
+        first_name=username.title(),
+        last_name='Last',
+        email=f'{username}@example.com',
+        department=department,
+        date_of_joining=date_of_joining
+    )
+    if termination_date:
+        EmployeeTimeline.objects.create(
+            employee=employee,
+            event_type='TERM',
+            title='Terminated',
+            event_date=termination_date
+        )
+    return employee
+
+
+class CustomReportCompilerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        sales = Department.objects.create(name='Sales')
+        support = Department.objects.create(name='Support')
+        for index, department in enumerate([sales, sales, sales, support]):
+            user = User.objects.create_user(username=f'user{index}')
+            Employee.objects.create(
+                user=user,
+                first_name=f'First{index}',
+                last_name='Last',
+                email=f'user{index}@example.com',
+                department=department,
+                date_of_joining=date(2024, 1, 1)
+            )
+
+    def setUp(self):
+        self.compiler = CustomReportCompiler()
+
+    def assertRejected(self, spec, columns=None):
+        with self.assertRaises(ValueError):
+            self.compiler.compile(spec, columns)
+
+    def test_rejects_unknown_entity(self):
+        self.assertRejected({'entity': 'user'})
+
+    def test_rejects_fields_outside_whitelist(self):
+        self.assertRejected({'entity': 'employee', 'where': [{'field': 'account_number', 'value': '1'}]})
+        self.assertRejected({'entity': 'employee'}, columns=['department.manager'])
+
+    def test_rejects_joins_outside_whitelist(self):
+        self.assertRejected({'entity': 'employee', 'joins': ['user']})
+        self.assertRejected({'entity': 'employee'}, columns=['user.username'])
+
+    def test_rejects_invalid_spec_shapes(self):
+        self.assertRejected({'entity': 'employee', 'limit': 10})
+        self.assertRejected({'entity': 'employee', 'where': [{'field': 'first_name', 'op': 'like', 'value': 'F'}]})
+        self.assertRejected({'entity': 'employee', 'where': [{'field': 'date_of_joining', 'op': 'gt', 'value': 'soon'}]})
+        self.assertRejected({'entity': 'employee', 'aggregates': [{'name': 'total', 'function': 'sum'}]})
+        self.assertRejected({'entity': 'employee', 'aggregates': [{'name': 'bad name', 'function': 'count'}]})
+
+    def test_grouped_columns_must_be_grouped_or_aggregated(self):
+        self.assertRejected({
+            'entity': 'employee',
+            'group_by': ['department.name'],
+            'aggregates': [{'name': 'headcount', 'function': 'count'}],
+        }, columns=['first_name'])
+
+    def test_group_by_with_having(self):
+        plan = self.compiler.compile({
+            'entity': 'employee',
+            'where': [{'field': 'is_active', 'value': True}],
+            'group_by': ['department.name'],
+            'aggregates': [{'name': 'headcount', 'function': 'count'}],
+            'order_by': ['-headcount'],
+        })
+        self.assertEqual(plan.columns, ['department.name', 'headcount'])
+        self.assertEqual(
+            list(plan.queryset.values_list('department.name', 'headcount')),
+            [('Sales', 3), ('Support', 1)]
+        )
+
+        plan = self.compiler.compile({
+            'entity': 'employee',
+            'group_by': ['department.name'],
+            'aggregates': [{'name': 'headcount', 'function': 'count'}],
+            'where': [{'field': 'headcount', 'op': 'gte', 'value': 2}],
+        })
+        sql = str(plan.queryset.query)
+        self.assertIn('GROUP BY', sql)
+        self.assertIn('HAVING', sql)
+        self.assertEqual(list(plan.queryset.values_list('department.name', 'headcount')), [('Sales', 3)])
+        self.assertEqual(plan.queryset.count(), 1)
+
+    def test_totals_without_group_by(self):
+        plan = self.compiler.compile({'entity': 'employee', 'aggregates': [{'name': 'total', 'function': 'count'}]})
+        self.assertEqual(list(plan.queryset.values_list('total', flat=True)), [4])
+        self.assertEqual(plan.queryset.count(), 1)
+
+    def test_plans_are_cached_by_spec(self):
+        spec = {'entity': 'employee', 'where': [{'field': 'department.name', 'value': 'Sales'}]}
+        plan = self.compiler.compile(spec)
+        self.assertIs(self.compiler.compile(dict(reversed(list(spec.items())))), plan)
+        self.assertIsNot(self.compiler.compile(spec, ['first_name']), plan)
+        # The default columns join department and designation
+        self.assertEqual(plan.models, [Department, Designation, Employee])
+
+
+class HeadcountSeriesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sales = Department.objects.create(name='Sales')
+        cls.support = Department.objects.create(name='Support')
+        create_employee('ann', cls.sales, date(2024, 1, 3))
+        create_employee('bob', cls.support, date(2023, 6, 1), termination_date=date(2024, 1, 4))
+        create_employee('cat', None, date(2024, 1, 2))
+        create_employee('dan', cls.sales, date(2024, 2, 1))
+
+    def test_counts_per_department_and_day(self):
+        dates, department_ids, counts, totals = headcount_series(date(2024, 1, 1), date(2024, 1, 5))
+
+        self.assertEqual(dates[0], date(2024, 1, 1))
+        self.assertEqual(len(dates), 5)
+        self.assertEqual(department_ids, [self.sales.pk, self.support.pk])
+        self.assertEqual(counts.tolist(), [[0, 0, 1, 1, 1], [1, 1, 1, 0, 0]])
+        # The total includes employees without a department
+        self.assertEqual(totals.tolist(), [1, 2, 3, 2, 2])
+
+    def test_matches_active_employees_on_each_day(self):
+        dates, _, _, totals = headcount_series(date(2023, 12, 30), date(2024, 2, 2))
+        self.assertEqual(totals.tolist(), [active_employees(day).count() for day in dates])
+
+    def test_department_ids_limit_rows_but_not_totals(self):
+        _, department_ids, counts, totals = headcount_series(
+            date(2024, 1, 1), date(2024, 1, 5), department_ids=[self.support.pk]
+        )
+        self.assertEqual(department_ids, [self.support.pk])
+        self.assertEqual(counts.tolist(), [[1, 1, 1, 0, 0]])
+        self.assertEqual(totals.tolist(), [1, 2, 3, 2, 2])
+
+
+class HRMetricWriterTests(TestCase):
+    def write(self, value):
+        writer = HRMetricWriter()
+        writer.add('headcount', date(2024, 1, 1), value=value)
+        writer.add('headcount', date(2024, 1, 1), granularity='month', value=value)
+        writer.flush()
+
+    def test_rewriting_company_wide_rows_updates_in_place(self):
+        self.write(10)
+        self.write(12)
+
+        rows = HRMetric.objects.filter(metric_type='headcount', department__isnull=True)
+        self.assertEqual(rows.count(), 2)
+        self.assertEqual(set(rows.values_list('granularity', 'value')), {('day', 12), ('month', 12)})
+
+
+class MetricDeltaTests(TestCase):
+    start_date = date(2024, 1, 1)
+    end_date = date(2024, 4, 30)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sales = Department.objects.create(name='Sales')
+        cls.support = Department.objects.create(name='Support')
+        create_employee('ann', cls.sales, date(2023, 1, 1))
+        create_employee('bob', cls.support, date(2023, 6, 1))
+        cls.cat = create_employee('cat', cls.support, date(2023, 9, 1))
+
+    def setUp(self):
+        # Start from fully calculated metrics with nothing pending
+        MetricsCalculator().apply_pending_deltas()
+        MetricsCalculator().calculate_all_metrics(self.start_date, self.end_date)
+
+    def stored_metrics(self):
+        return {
+            (row.metric_type, row.date, row.department_id, row.granularity): (
+                row.value, row.percentage_value, row.calculation_details
+            )
+            for row in HRMetric.objects.all()
+        }
+
+    def assertMatchesFullRecalculation(self):
+        self.assertTrue(MetricsCalculator().apply_pending_deltas())
+        incremental = self.stored_metrics()
+
+        HRMetric.objects.all().delete()
+        MetricsCalculator().calculate_all_metrics(self.start_date, self.end_date)
+        self.assertEqual(incremental, self.stored_metrics())
+
+    def test_join_on_first_of_month(self):
+        create_employee('dan', self.sales, date(2024, 3, 1))
+        self.assertMatchesFullRecalculation()
+
+    def test_termination_on_first_of_month(self):
+        EmployeeTimeline.objects.create(
+            employee=self.cat, event_type='TERM', title='Terminated', event_date=date(2024, 2, 1)
+        )
+        self.assertMatchesFullRecalculation()
+
+    def test_department_change(self):
+        self.cat.department = self.sales
+        self.cat.save()
+        self.assertMatchesFullRecalculation()
+
+
+class RollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        sales = Department.objects.create(name='Sales')
+        for index in range(4):
+            create_employee(f'base{index}', sales, date(2023, 1, 1),
+                            termination_date=date(2024, 5, 10) if index == 0 else None)
+        joins = [date(2023, 12, 15), date(2024, 3, 5), date(2024, 3, 20), date(2024, 4, 10),
+                 date(2024, 5, 2), date(2024, 6, 1), date(2024, 6, 30)]
+        for index, joined in enumerate(joins):
+            create_employee(f'hire{index}', sales, joined)
+
+        MetricsCalculator().calculate_all_metrics(date(2024, 1, 1), date(2024, 7, 31))
+
+    def rollup(self, metric_type, granularity, day):
+        return HRMetric.objects.get(
+            metric_type=metric_type, granularity=granularity, date=day, department__isnull=True
+        )
+
+    def test_flow_metrics_roll_up_into_the_month_they_cover(self):
+        # Hires are counted on the 1st of the following month
+        self.assertEqual(self.rollup('new_hires', 'month', date(2024, 4, 1)).value, 1)
+        self.assertEqual(self.rollup('new_hires', 'quarter', date(2024, 4, 1)).value, 4)
+        self.assertEqual(self.rollup('new_hires', 'quarter', date(2024, 1, 1)).value, 2)
+        self.assertEqual(self.rollup('new_hires', 'year', date(2024, 1, 1)).value, 6)
+        # December hires belong to the previous year
+        self.assertEqual(self.rollup('new_hires', 'month', date(2023, 12, 1)).value, 1)
+        self.assertEqual(self.rollup('new_hires', 'year', date(2023, 1, 1)).value, 1)
+
+    def test_stock_metrics_keep_the_last_value(self):
+        self.assertEqual(self.rollup('headcount', 'month', date(2024, 6, 1)).value, 10)
+        self.assertEqual(self.rollup('headcount', 'quarter', date(2024, 1, 1)).value, 7)
+
+    def test_attrition_rate_is_recomputed_from_totals(self):
+        quarter = self.rollup('attrition_rate', 'quarter', date(2024, 4, 1))
+        self.assertEqual(quarter.value, 1)
+        # Average headcounts of April, May and June are 7.5, 8 and 9
+        self.assertAlmostEqual(quarter.calculation_details['avg_headcount'], 24.5 / 3)
+        self.assertAlmostEqual(float(quarter.percentage_value), 100 / (24.5 / 3), places=2)
+
+
+class ReportWriterTests(TestCase):
+    columns = ['name', 'joined', 'days']
+
+    def setUp(self):
+        self.generator = ReportGenerator()
+
+    def rows(self, count):
+        return ({'name': f'Employee {index}', 'joined': date(2024, 1, 1), 'days': index} for index in range(count))
+
+    def test_csv(self):
+        file, record_count = self.generator.generate_csv(self.columns, self.rows(3))
+        with file:
+            self.assertEqual(record_count, 3)
+            self.assertEqual(file.read().decode().splitlines(), [
+                'name,joined,days',
+                'Employee 0,2024-01-01,0',
+                'Employee 1,2024-01-01,1',
+                'Employee 2,2024-01-01,2',
+            ])
+
+    def test_csv_without_rows(self):
+        file, record_count = self.generator.generate_csv(self.columns, iter([]))
+        with file:
+            self.assertEqual(record_count, 0)
+            self.assertEqual(file.read(), b'name,joined,days\r\n')
+
+    @override_settings(TIME_ZONE='Asia/Kolkata')
+    def test_excel(self):
+        created_at = datetime(2024, 1, 1, 6, 30, tzinfo=dt_timezone.utc)
+        rows = ({**row, 'created_at': created_at} for row in self.rows(2))
+        file, record_count = self.generator.generate_excel(self.columns + ['created_at'], rows, title='Employees')
+        with file:
+            self.assertEqual(record_count, 2)
+            worksheet = openpyxl.load_workbook(file).active
+            self.assertEqual(worksheet.title, 'Employees')
+            self.assertEqual(list(worksheet.values), [
+                ('name', 'joined', 'days', 'created_at'),
+                # Timezone-aware datetimes are written in local time
+                ('Employee 0', datetime(2024, 1, 1), 0, datetime(2024, 1, 1, 12, 0)),
+                ('Employee 1', datetime(2024, 1, 1), 1, datetime(2024, 1, 1, 12, 0)),
+            ])
+
+    def test_excel_failure_removes_temporary_files(self):
+        def failing_rows():
+            yield from self.rows(2)
+            raise RuntimeError('query failed')
+
+        pattern = os.path.join(tempfile.gettempdir(), 'openpyxl.*')
+        existing = set(glob.glob(pattern))
+        with self.assertRaises(RuntimeError):
+            self.generator.generate_excel(self.columns, failing_rows())
+        self.assertEqual(set(glob.glob(pattern)), existing)
+
+    def pdf_pages(self, file):
+        with file:
+            return len(PdfReader(BytesIO(file.read())).pages)
+
+    @skipUnless(PdfReader, 'pypdf is not installed')
+    def test_pdf_has_one_page_per_table(self):
+        file, record_count = self.generator.generate_pdf(self.columns, self.rows(65), workers=1)
+        self.assertEqual(record_count, 65)
+        self.assertEqual(self.pdf_pages(file), 3)
+
+    @skipUnless(PdfReader, 'pypdf is not installed')
+    def test_parallel_pdf_parts_end_on_full_pages(self):
+        self.assertEqual(utils.PDF_ROWS_PER_PART % utils.PDF_ROWS_PER_TABLE, 0)
+
+        with mock.patch.object(utils, 'PDF_ROWS_PER_PART', utils.PDF_ROWS_PER_TABLE * 2):
+            file, record_count = self.generator.generate_pdf(self.columns, self.rows(130), workers=2)
+        self.assertEqual(record_count, 130)
+        self.assertEqual(self.pdf_pages(file), 5)
+
+
+class ByteRangeTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        storage = FileSystemStorage(location=self.directory)
+        name = storage.save('report.csv', ContentFile(b'0123456789'))
+        self.file = SimpleNamespace(name=name, storage=storage, size=10)
+        self.factory = RequestFactory()
+
+    def test_parse_byte_range(self):
+        self.assertEqual(parse_byte_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(parse_byte_range('bytes=7-', 10), (7, 9))
+        self.assertEqual(parse_byte_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_byte_range('bytes=8-100', 10), (8, 9))
+        self.assertIsNone(parse_byte_range('bytes=0-1,4-5', 10))
+        self.assertIsNone(parse_byte_range('items=0-1', 10))
+        for header in ('bytes=10-', 'bytes=5-2', 'bytes=-0'):
+            with self.assertRaises(RangeNotSatisfiable):
+                parse_byte_range(header, 10)
+
+    def test_single_range_is_partial_content(self):
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=2-5'), self.file)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+    def test_multi_range_serves_whole_file(self):
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=0-1,4-5'), self.file)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Range', response)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_unsatisfiable_range(self):
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=20-30'), self.file)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+
+class SharedReportOutputTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.enterContext(self.settings(MEDIA_ROOT=directory))
+
+        owner = create_employee('owner', None, date(2024, 1, 1))
+        self.executions = [
+            ReportExecution.objects.create(report=Report.objects.create(
+                name=name, report_type='headcount', format='csv', created_by=owner
+            ))
+            for name in ('Weekly headcount', 'Board pack')
+        ]
+
+    def test_coalesced_execution_is_named_after_its_own_report(self):
+        first, second = self.executions
+        generate_report_task(first.id, [second.id])
+        first.refresh_from_db()
+        second.refresh_from_db()
+
+        self.assertEqual(second.status, 'completed')
+        self.assertEqual(second.blob_id, first.blob_id)
+        self.assertRegex(first.output_name, r'^Weekly headcount_\d{8}_\d{6}\.csv$')
+        self.assertRegex(second.output_name, r'^Board pack_\d{8}_\d{6}\.csv$')
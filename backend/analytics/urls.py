@@ -1,12 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ReportViewSet, ReportExecutionViewSet, CertificateViewSet, HRMetricViewSet
+from .views import ReportViewSet, ReportExecutionViewSet, CertificateViewSet, HRMetricViewSet, MetricsJobViewSet
 
 router = DefaultRouter()
 router.register(r'reports', ReportViewSet)
 router.register(r'report-executions', ReportExecutionViewSet)
 router.register(r'certificates', CertificateViewSet)
 router.register(r'hr-metrics', HRMetricViewSet)
+router.register(r'metric-jobs', MetricsJobViewSet)
 
 app_name = 'analytics'
 
@@ -1,17 +1,49 @@
-import pandas as pd
-from django.db.models import Count, Avg, Q, Sum, F
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    Count, Avg, Q, Sum, F, Min, Max, OuterRef, Subquery, Value,
+    ExpressionWrapper, DateField, DurationField
+)
 from django.utils import timezone
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 from io import BytesIO
+import csv
+import hashlib
+import io
+import json
+import tempfile
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+try:
+    from pypdf import PdfWriter
+except ImportError:  # Parallel PDF rendering is optional
+    PdfWriter = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Parquet and Arrow report formats are optional
+    pyarrow = None
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter, A4
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.platypus import SimpleDocTemplate, LongTable, TableStyle, Paragraph, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
-from employees.models import Employee, Department
-from leave.models import LeaveRequest, LeaveBalance
-from .models import Certificate, HRMetric
+from employees.models import Employee, Department, Designation, EmployeeTimeline
+from leave.models import LeaveRequest, LeaveBalance, LeaveType
+from .models import Certificate, HRMetric, MetricDelta, DataVersion
+from .custom_reports import CUSTOM_REPORT_MODELS, custom_report_compiler
+from .report_columns import project_report_rows, report_column_fields
+
+
+# Value types openpyxl can write to a cell as-is
+EXCEL_CELL_TYPES = (int, float, Decimal, str, bool, date, datetime, time, timedelta)
 
 
 class ReportGenerator:
@@ -20,21 +52,78 @@ class ReportGenerator:
     def __init__(self):
         self.styles = getSampleStyleSheet()
     
+    # Rows fetched per database round trip when streaming a report
+    chunk_size = 2000
+    
     def get_report_data(self, report):
         """Get data for a specific report based on its type and filters"""
+        columns, rows = self.get_report_rows(report)
+        data = list(rows)
+        
+        return {
+            'columns': columns,
+            'data': data,
+            'total_records': len(data)
+        }
+    
+    def get_report_query(self, report):
+        """Return the columns of a report and the queryset its rows are read from"""
         if report.report_type == 'headcount':
-            return self._get_headcount_data(report)
+            return self._get_headcount_query(report)
         elif report.report_type == 'attrition':
-            return self._get_attrition_data(report)
+            return self._get_attrition_query(report)
         elif report.report_type == 'leave_utilization':
-            return self._get_leave_utilization_data(report)
+            return self._get_leave_utilization_query(report)
         elif report.report_type == 'certificate_expiry':
-            return self._get_certificate_expiry_data(report)
+            return self._get_certificate_expiry_query(report)
+        elif report.report_type == 'custom':
+            return self._get_custom_query(report)
         else:
             raise ValueError(f"Unknown report type: {report.report_type}")
     
-    def _get_headcount_data(self, report):
-        """Generate headcount report data"""
+    def get_report_rows(self, report, limit=None):
+        """Return the columns of a report and a lazy iterator over its rows"""
+        columns, queryset = self.get_report_query(report)
+        if limit is not None:
+            queryset = queryset[:limit]
+        return columns, project_report_rows(report.report_type, queryset, columns, self.chunk_size)
+    
+    def count_report_rows(self, report):
+        """
+        Count the rows of a report with a COUNT query.
+        
+        Counts are cached for REPORT_PREVIEW_COUNT_CACHE_TIMEOUT seconds
+        (0 disables caching) under the report type, filters and the data
+        version of the tables the report reads.
+        """
+        timeout = getattr(settings, 'REPORT_PREVIEW_COUNT_CACHE_TIMEOUT', 60)
+        filters = json.dumps(report.filters or {}, sort_keys=True, default=str)
+        cache_key = 'report_count:' + hashlib.sha1(
+            f"{report.report_type}:{filters}:{report_data_version(report)}".encode()
+        ).hexdigest()
+        
+        if timeout:
+            total_records = cache.get(cache_key)
+            if total_records is not None:
+                return total_records
+        
+        _, queryset = self.get_report_query(report)
+        total_records = queryset.count()
+        if timeout:
+            cache.set(cache_key, total_records, timeout)
+        return total_records
+    
+    def get_report_preview(self, report, limit=10):
+        """First `limit` rows of a report and its total row count"""
+        columns, rows = self.get_report_rows(report, limit=limit)
+        return {
+            'columns': columns,
+            'data': list(rows),
+            'total_records': self.count_report_rows(report)
+        }
+    
+    def _get_headcount_query(self, report):
+        """Build the headcount report query"""
         queryset = Employee.objects.all()
         
         # Apply filters
@@ -42,44 +131,64 @@ class ReportGenerator:
         if filters.get('department_id'):
             queryset = queryset.filter(department_id=filters['department_id'])
         if filters.get('status'):
-            queryset = queryset.filter(status=filters['status'])
+            queryset = queryset.filter(employment_status=filters['status'])
         if filters.get('hire_date_from'):
-            queryset = queryset.filter(hire_date__gte=filters['hire_date_from'])
+            queryset = queryset.filter(date_of_joining__gte=filters['hire_date_from'])
         if filters.get('hire_date_to'):
-            queryset = queryset.filter(hire_date__lte=filters['hire_date_to'])
+            queryset = queryset.filter(date_of_joining__lte=filters['hire_date_to'])
         
         # Select columns
         columns = report.columns or ['employee_id', 'full_name', 'department', 'designation', 'hire_date', 'status']
         
-        data = []
-        for employee in queryset.select_related('department', 'designation'):
-            row = {}
-            for col in columns:
-                if col == 'employee_id':
-                    row[col] = employee.employee_id
-                elif col == 'full_name':
-                    row[col] = employee.full_name
-                elif col == 'department':
-                    row[col] = employee.department.name if employee.department else ''
-                elif col == 'designation':
-                    row[col] = employee.designation.title if employee.designation else ''
-                elif col == 'hire_date':
-                    row[col] = employee.date_of_joining.isoformat() if employee.date_of_joining else ''
-                elif col == 'status':
-                    row[col] = employee.is_active
-                else:
-                    row[col] = getattr(employee, col, '')
-            data.append(row)
+        return columns, queryset
+    
+    def _get_attrition_query(self, report):
+        """Build the attrition report query: employees with a termination event"""
+        queryset = with_termination_date(Employee.objects.all()).filter(termination_date__isnull=False)
         
-        return {
-            'columns': columns,
-            'data': data,
-            'total_records': len(data)
-        }
+        # Apply filters
+        filters = report.filters
+        if filters.get('department_id'):
+            queryset = queryset.filter(department_id=filters['department_id'])
+        if filters.get('termination_date_from'):
+            queryset = queryset.filter(termination_date__gte=filters['termination_date_from'])
+        if filters.get('termination_date_to'):
+            queryset = queryset.filter(termination_date__lte=filters['termination_date_to'])
+        if filters.get('hire_date_from'):
+            queryset = queryset.filter(date_of_joining__gte=filters['hire_date_from'])
+        if filters.get('hire_date_to'):
+            queryset = queryset.filter(date_of_joining__lte=filters['hire_date_to'])
+        
+        columns = report.columns or ['employee_id', 'full_name', 'department', 'hire_date', 'termination_date', 'reason']
+        
+        return columns, queryset.order_by('-termination_date', 'first_name', 'last_name')
     
-    def _get_certificate_expiry_data(self, report):
-        """Generate certificate expiry report data"""
-        queryset = Certificate.objects.select_related('employee')
+    def _get_leave_utilization_query(self, report):
+        """Build the leave utilization report query: one row per leave balance"""
+        queryset = LeaveBalance.objects.all()
+        
+        # Apply filters
+        filters = report.filters
+        queryset = queryset.filter(year=filters.get('year') or timezone.now().year)
+        if filters.get('department_id'):
+            queryset = queryset.filter(employee__department_id=filters['department_id'])
+        if filters.get('leave_type_id'):
+            queryset = queryset.filter(leave_type_id=filters['leave_type_id'])
+        if filters.get('employee_id'):
+            queryset = queryset.filter(employee_id=filters['employee_id'])
+        
+        columns = report.columns or ['employee_id', 'full_name', 'leave_type', 'total_days', 'used_days', 'balance']
+        
+        return columns, queryset.order_by('employee__first_name', 'employee__last_name', 'leave_type__name')
+    
+    def _get_custom_query(self, report):
+        """Compile the query spec of a custom report, reusing cached plans"""
+        plan = custom_report_compiler.compile(report.filters, report.columns)
+        return plan.columns, plan.queryset.all()
+    
+    def _get_certificate_expiry_query(self, report):
+        """Build the certificate expiry report query"""
+        queryset = Certificate.objects.all()
         
         # Apply filters
         filters = report.filters
@@ -95,92 +204,593 @@ class ReportGenerator:
         
         columns = report.columns or ['employee_id', 'employee_name', 'certificate_name', 'certificate_type', 'expiry_date', 'days_until_expiry']
         
-        data = []
-        for cert in queryset:
-            row = {}
-            for col in columns:
-                if col == 'employee_id':
-                    row[col] = cert.employee.employee_id
-                elif col == 'employee_name':
-                    row[col] = cert.employee.full_name
-                elif col == 'certificate_name':
-                    row[col] = cert.name
-                elif col == 'certificate_type':
-                    row[col] = cert.get_certificate_type_display()
-                elif col == 'expiry_date':
-                    row[col] = cert.expiry_date.isoformat()
-                elif col == 'days_until_expiry':
-                    row[col] = cert.days_until_expiry
-                else:
-                    row[col] = getattr(cert, col, '')
-            data.append(row)
+        return columns, queryset
+    
+    def generate_csv(self, columns, rows):
+        """
+        Stream report rows into a CSV temporary file.
         
-        return {
-            'columns': columns,
-            'data': data,
-            'total_records': len(data)
-        }
+        Returns the file, rewound and ready to be saved to storage, and the
+        number of rows written.
+        """
+        file_buffer = tempfile.TemporaryFile()
+        text = io.TextIOWrapper(file_buffer, encoding='utf-8', newline='')
+        writer = csv.DictWriter(text, fieldnames=columns)
+        writer.writeheader()
+        
+        record_count = 0
+        for row in rows:
+            writer.writerow(row)
+            record_count += 1
+        
+        text.flush()
+        text.detach()
+        file_buffer.seek(0)
+        return file_buffer, record_count
     
-    def generate_pdf(self, report_data, title="Report"):
-        """Generate PDF report"""
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4)
-        story = []
-        
-        # Title
-        title_para = Paragraph(title, self.styles['Title'])
-        story.append(title_para)
-        
-        # Table data
-        table_data = [report_data['columns']]  # Header
-        table_data.extend([list(row.values()) for row in report_data['data']])
-        
-        # Create table
-        table = Table(table_data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        
-        story.append(table)
-        doc.build(story)
-        
-        buffer.seek(0)
-        return buffer
-    
-    def generate_excel(self, report_data, title="Report"):
-        """Generate Excel report"""
-        buffer = BytesIO()
-        
-        # Create DataFrame
-        df = pd.DataFrame(report_data['data'])
-        
-        # Write to Excel
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name=title, index=False)
-            
-            # Get the workbook and worksheet
-            workbook = writer.book
-            worksheet = writer.sheets[title]
+    def generate_pdf(self, columns, rows, title="Report", workers=None):
+        """
+        Stream report rows into a PDF temporary file.
+        
+        Rows are laid out as page-sized LongTable chunks that are pulled
+        from the row iterator while the document is being built, so layout
+        time grows linearly with the number of rows. With more than one
+        worker (REPORT_PDF_WORKERS) and pypdf installed, ranges of pages are
+        rendered in separate processes and concatenated. Returns the rewound
+        file and the number of rows written.
+        """
+        if workers is None:
+            workers = getattr(settings, 'REPORT_PDF_WORKERS', 1)
+        
+        file_buffer = tempfile.TemporaryFile()
+        if workers > 1 and PdfWriter is not None:
+            record_count = self._generate_pdf_parallel(file_buffer, columns, rows, title, workers)
+        else:
+            record_count = build_pdf(file_buffer, columns, rows, title)
+        
+        file_buffer.seek(0)
+        return file_buffer, record_count
+    
+    def _generate_pdf_parallel(self, file_buffer, columns, rows, title, workers):
+        """Render parts of the report in a process pool and join them in order"""
+        writer = PdfWriter()
+        record_count = 0
+        pending = deque()
+        
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for index, part in enumerate(chunked(rows, PDF_ROWS_PER_PART)):
+                record_count += len(part)
+                pending.append(pool.submit(render_pdf_part, columns, part, title if index == 0 else None))
+                # Keep a bounded number of parts in flight
+                if len(pending) > workers * 2:
+                    writer.append(BytesIO(pending.popleft().result()))
             
-            # Format header
-            for cell in worksheet[1]:
-                cell.font = openpyxl.styles.Font(bold=True)
-                cell.fill = openpyxl.styles.PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+            if not record_count:
+                pending.append(pool.submit(render_pdf_part, columns, [], title))
+            while pending:
+                writer.append(BytesIO(pending.popleft().result()))
+        
+        writer.write(file_buffer)
+        return record_count
+    
+    def get_report_fields(self, report):
+        """Model fields describing the value types of each report column"""
+        columns, queryset = self.get_report_query(report)
+        return report_column_fields(report.report_type, queryset, columns)
+    
+    def generate_columnar(self, columns, rows, fields, file_format='parquet'):
+        """
+        Stream report rows into a Parquet or Arrow IPC temporary file.
+        
+        Rows are written as Arrow record batches of ARROW_BATCH_ROWS rows
+        with a schema derived from the column model fields, so dates and
+        decimals keep their types. Requires pyarrow. Returns the rewound
+        file and the number of rows written.
+        """
+        if pyarrow is None:
+            raise ValueError("Parquet and Arrow report formats require pyarrow to be installed")
+        
+        schema = pyarrow.schema([
+            pyarrow.field(column, arrow_type(field)) for column, field in zip(columns, fields)
+        ])
+        # Arrow has no UUID type; those columns are written as text
+        text_columns = [
+            column for column, field in zip(columns, fields)
+            if schema.field(column).type == pyarrow.string()
+        ]
+        
+        file_buffer = tempfile.TemporaryFile()
+        if file_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(file_buffer, schema, compression='zstd')
+        else:
+            writer = pyarrow.ipc.new_file(file_buffer, schema)
+        
+        record_count = 0
+        with writer:
+            for chunk in chunked(rows, ARROW_BATCH_ROWS):
+                for row in chunk:
+                    for column in text_columns:
+                        if row[column] is not None:
+                            row[column] = str(row[column])
+                writer.write_batch(pyarrow.RecordBatch.from_pylist(chunk, schema=schema))
+                record_count += len(chunk)
+        
+        file_buffer.seek(0)
+        return file_buffer, record_count
+    
+    def generate_excel(self, columns, rows, title="Report"):
+        """
+        Stream report rows into an Excel temporary file.
+        
+        Uses an openpyxl write-only workbook, so rows are serialised as they
+        arrive instead of being held as a worksheet object model. Returns
+        the rewound file and the number of rows written.
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        # Excel limits sheet names to 31 characters
+        worksheet = workbook.create_sheet(title=title[:31])
+        
+        # Format header
+        header = []
+        for column in columns:
+            cell = WriteOnlyCell(worksheet, value=column)
+            cell.font = openpyxl.styles.Font(bold=True)
+            cell.fill = openpyxl.styles.PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+            header.append(cell)
+        worksheet.append(header)
+        
+        file_buffer = tempfile.TemporaryFile()
+        record_count = 0
+        try:
+            for row in rows:
+                worksheet.append([self._excel_value(row.get(column)) for column in columns])
+                record_count += 1
+        except BaseException:
+            # The sheet streams into its own temporary file, which only
+            # workbook.save() removes, so save the partial workbook and discard it
+            with file_buffer:
+                workbook.save(file_buffer)
+            raise
+        
+        workbook.save(file_buffer)
+        file_buffer.seek(0)
+        return file_buffer, record_count
+    
+    def _excel_value(self, value):
+        """Cells hold numbers, text, booleans and dates; anything else is written as text"""
+        if isinstance(value, datetime) and timezone.is_aware(value):
+            # Excel has no time zones, so write the local time
+            return timezone.localtime(value).replace(tzinfo=None)
+        if value is None or isinstance(value, EXCEL_CELL_TYPES):
+            return value
+        return str(value)
+
+
+# Rows per LongTable chunk; each chunk starts a new A4 page and fits on it
+PDF_ROWS_PER_TABLE = 30
+
+# Rows rendered by each worker when PDFs are built in parallel; a whole
+# number of tables, so only the last part can end on a partial page
+PDF_ROWS_PER_PART = PDF_ROWS_PER_TABLE * 167
+
+PDF_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+
+# Rows per record batch in Parquet and Arrow output
+ARROW_BATCH_ROWS = 10000
+
+
+def arrow_type(field):
+    """Arrow type for the values of a Django model field"""
+    internal_type = field.get_internal_type()
+    if internal_type == 'BooleanField':
+        return pyarrow.bool_()
+    if internal_type in ('IntegerField', 'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+                         'PositiveBigIntegerField', 'PositiveSmallIntegerField', 'AutoField', 'BigAutoField'):
+        return pyarrow.int64()
+    if internal_type == 'FloatField':
+        return pyarrow.float64()
+    if internal_type == 'DecimalField':
+        return pyarrow.decimal128(field.max_digits, field.decimal_places)
+    if internal_type == 'DateField':
+        return pyarrow.date32()
+    if internal_type == 'DateTimeField':
+        return pyarrow.timestamp('us', tz='UTC')
+    if internal_type == 'DurationField':
+        return pyarrow.duration('us')
+    return pyarrow.string()
+
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` items from an iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ChunkedDocTemplate(SimpleDocTemplate):
+    """
+    Document template that pulls flowables from an iterator during the build.
+    
+    Only the flowable being laid out and the next one are held in the
+    story, so the whole report never has to exist as flowables at once.
+    """
+    
+    def build(self, flowables, pending=(), **kwargs):
+        self._story = flowables
+        self._pending_flowables = iter(pending)
+        self.filterFlowables(flowables)
+        super().build(flowables, **kwargs)
+    
+    def filterFlowables(self, flowables):
+        # Also called for reportlab's internal page-start list; only top up the story
+        if flowables is self._story and len(flowables) < 2:
+            flowables.extend(islice(self._pending_flowables, 1))
+
+
+def build_pdf(file, columns, rows, title=None):
+    """Lay out report rows into `file` as page-sized tables, returning the row count"""
+    # invariant output makes identical reports byte-identical, so they share a blob
+    doc = ChunkedDocTemplate(file, pagesize=A4, invariant=True)
+    # Fixed, equal column widths keep every chunk aligned with the others
+    col_widths = [doc.width / max(len(columns), 1)] * len(columns)
+    header = list(columns)
+    record_count = 0
+    
+    def tables():
+        nonlocal record_count
+        for chunk in chunked(rows, PDF_ROWS_PER_TABLE):
+            record_count += len(chunk)
+            table_data = [header]
+            table_data.extend([
+                ['' if row.get(col) is None else str(row.get(col)) for col in columns]
+                for row in chunk
+            ])
+            yield table_data
         
-        buffer.seek(0)
-        return buffer
+        if not record_count:
+            yield [header]
+    
+    def flowables():
+        for index, table_data in enumerate(tables()):
+            if index:
+                yield PageBreak()
+            table = LongTable(table_data, colWidths=col_widths, repeatRows=1)
+            table.setStyle(PDF_TABLE_STYLE)
+            yield table
+    
+    story = [Paragraph(title, getSampleStyleSheet()['Title'])] if title else []
+    doc.build(story, pending=flowables())
+    
+    return record_count
+
+
+def render_pdf_part(columns, rows, title=None):
+    """Render one range of report rows to PDF bytes (runs in a worker process)"""
+    buffer = BytesIO()
+    build_pdf(buffer, columns, rows, title)
+    return buffer.getvalue()
+
+
+def with_termination_date(queryset):
+    """Annotate employees with the date of their first termination event"""
+    termination_events = EmployeeTimeline.objects.filter(
+        employee=OuterRef('pk'),
+        event_type='TERM'
+    ).order_by('event_date').values('event_date')[:1]
+    return queryset.annotate(termination_date=Subquery(termination_events))
+
+
+def active_employees(date):
+    """Employees who had joined on `date` and were not yet terminated"""
+    return with_termination_date(Employee.objects.all()).filter(
+        Q(date_of_joining__lte=date) &
+        (Q(termination_date__isnull=True) | Q(termination_date__gt=date))
+    )
+
+
+def headcount_series(start_date, end_date, department_ids=None):
+    """
+    Compute the daily headcount for every department over a date range.
+
+    Employment is treated as the half-open interval [date_of_joining,
+    termination_date), fetched with a single query and turned into per-day
+    counts with a difference array, so the cost does not depend on how many
+    days or departments are in the range.
+
+    Returns (dates, department_ids, counts, totals) where counts has one row
+    per department and one column per day. Passing department_ids limits the
+    per-department rows; totals always cover the whole company.
+    """
+    num_days = (end_date - start_date).days + 1
+    dates = [start_date + timedelta(days=offset) for offset in range(num_days)]
+
+    if department_ids is None:
+        department_ids = Department.objects.order_by('pk').values_list('pk', flat=True)
+    department_ids = sorted(department_ids)
+    index = {dept_id: i for i, dept_id in enumerate(department_ids)}
+    unassigned = len(department_ids)  # Employees without a department
+
+    intervals = with_termination_date(Employee.objects.all()).filter(
+        Q(date_of_joining__lte=end_date) &
+        (Q(termination_date__isnull=True) | Q(termination_date__gt=start_date))
+    ).values_list('department_id', 'date_of_joining', 'termination_date')
+
+    diff = np.zeros((unassigned + 1, num_days + 1), dtype=np.int64)
+    rows = []
+    starts = []
+    ends = []
+    for dept_id, joined, terminated in intervals:
+        rows.append(index.get(dept_id, unassigned))
+        starts.append((joined - start_date).days)
+        ends.append((terminated - start_date).days if terminated else num_days)
+
+    if rows:
+        rows = np.asarray(rows)
+        starts = np.clip(np.asarray(starts), 0, num_days)
+        ends = np.clip(np.asarray(ends), 0, num_days)
+        valid = ends > starts
+        np.add.at(diff, (rows[valid], starts[valid]), 1)
+        np.add.at(diff, (rows[valid], ends[valid]), -1)
+
+    per_row = np.cumsum(diff, axis=1)[:, :num_days]
+    return dates, department_ids, per_row[:unassigned], per_row.sum(axis=0)
+
+
+def downsample_lttb(x, y, max_points):
+    """
+    Pick the indices of at most max_points points that preserve the shape of
+    a series, using largest-triangle-three-buckets.
+    
+    The first and last points are always kept. The points in between are
+    split into equal buckets, and each bucket keeps the point forming the
+    largest triangle with the previously kept point and the next bucket's
+    average. Each bucket is scored with one NumPy expression.
+    """
+    n = len(x)
+    if max_points < 3 or n <= max_points:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = previous = 0
+    selected[-1] = n - 1
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_end = end, edges[bucket + 2]
+            next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous]) -
+            (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    
+    return selected
+
+
+# DataVersion key bumped on every HRMetric write, whatever the date
+HR_METRICS_VERSION_KEY = 'hr_metrics'
+
+
+def bump_hr_metric_versions(dates):
+    """Invalidate cached views over HR metrics for the given dates"""
+    DataVersion.bump(HR_METRICS_VERSION_KEY, *{hr_metric_version_key(date) for date in dates})
+
+
+def hr_metric_version_key(date):
+    """DataVersion key covering the HR metrics of one calendar month"""
+    return f"hr_metrics:{date.year}-{date.month:02d}"
+
+
+def hr_metric_version_keys(start_date, end_date):
+    """DataVersion keys for every month touched by a date range"""
+    keys = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        keys.append(f"hr_metrics:{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return keys
+
+
+# Models each report type reads; a write to any of them invalidates cached results
+REPORT_SOURCES = {
+    'headcount': [Employee, Department, Designation],
+    'attrition': [Employee, EmployeeTimeline, Department, Designation],
+    'leave_utilization': [LeaveBalance, LeaveRequest, LeaveType, Employee, Department],
+    'certificate_expiry': [Certificate, Employee],
+    # Custom reports read the tables of their compiled spec, see report_source_models
+    'custom': CUSTOM_REPORT_MODELS,
+}
+
+# Report types whose rows also change with today's date (expiry countdowns,
+# the current leave year)
+DATE_RELATIVE_REPORTS = {'certificate_expiry', 'leave_utilization'}
+
+
+def table_version_key(model):
+    """DataVersion key bumped on every write to a model's table"""
+    return f"table:{model._meta.label_lower}"
+
+
+def report_fingerprint(report):
+    """
+    Hash of everything that determines the output of a report.
+    
+    PDF and Excel files embed the report name as their title, so it is
+    part of the fingerprint for those formats.
+    """
+    spec = [report.report_type, report.filters or {}, report.columns or [], report.format]
+    if report.format in ('pdf', 'excel'):
+        spec.append(report.name)
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def report_source_models(report):
+    """Models a report reads"""
+    if report.report_type == 'custom':
+        try:
+            return custom_report_compiler.compile(report.filters, report.columns).models
+        except ValueError:
+            # Invalid specs fail when the report runs
+            pass
+    return REPORT_SOURCES.get(report.report_type, [])
+
+
+def report_data_version(report):
+    """Hash of the current versions of every table a report reads"""
+    keys = sorted(table_version_key(model) for model in report_source_models(report))
+    parts = [f"{key}={version}" for key, version in zip(keys, DataVersion.current(keys))]
+    if report.report_type in DATE_RELATIVE_REPORTS:
+        parts.append(timezone.now().date().isoformat())
+    return hashlib.sha1(';'.join(parts).encode()).hexdigest()
+
+
+class HRMetricWriter:
+    """
+    Collect computed HRMetric rows and upsert them in batches.
+
+    Rows are keyed on (metric_type, date, department, granularity) so adding
+    the same metric twice in a run keeps only the latest value.
+    """
+    
+    UPDATE_FIELDS = ['value', 'percentage_value', 'month', 'year', 'quarter', 'location', 'calculation_details']
+    
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.rows_written = 0
+    
+    def add(self, metric_type, date, department_id=None, granularity='day', **fields):
+        """Queue a metric row, flushing once a full batch is pending"""
+        self.add_row(HRMetric(
+            metric_type=metric_type,
+            date=date,
+            department_id=department_id,
+            granularity=granularity,
+            month=date.month,
+            year=date.year,
+            quarter=(date.month - 1) // 3 + 1,
+            **fields
+        ))
+    
+    def add_row(self, row):
+        """Queue an unsaved HRMetric instance"""
+        self.pending[(row.metric_type, row.date, row.department_id, row.granularity)] = row
+        if self.batch_size and len(self.pending) >= self.batch_size:
+            self.flush()
+    
+    def drain(self):
+        """Return and forget the pending rows without writing them"""
+        rows = list(self.pending.values())
+        self.pending = {}
+        return rows
+    
+    def flush(self):
+        """Write all pending rows"""
+        rows = list(self.pending.values())
+        self.pending = {}
+        
+        if rows:
+            self._upsert(rows)
+            bump_hr_metric_versions(row.date for row in rows)
+            self.rows_written += len(rows)
+        return len(rows)
+    
+    def _upsert(self, rows):
+        by_department = [row for row in rows if row.department_id is not None]
+        if by_department:
+            HRMetric.objects.bulk_create(
+                by_department,
+                update_conflicts=True,
+                unique_fields=['metric_type', 'date', 'department', 'granularity'],
+                update_fields=self.UPDATE_FIELDS
+            )
+        
+        # NULL never conflicts in a unique index, so company-wide rows are
+        # matched against existing ones explicitly.
+        company_wide = [row for row in rows if row.department_id is None]
+        if not company_wide:
+            return
+        
+        existing = {
+            (metric_type, date, granularity): pk
+            for pk, metric_type, date, granularity in HRMetric.objects.filter(
+                department__isnull=True,
+                metric_type__in={row.metric_type for row in company_wide},
+                granularity__in={row.granularity for row in company_wide},
+                date__range=[
+                    min(row.date for row in company_wide),
+                    max(row.date for row in company_wide)
+                ]
+            ).values_list('pk', 'metric_type', 'date', 'granularity')
+        }
+        
+        to_update = []
+        to_create = []
+        for row in company_wide:
+            row.pk = existing.get((row.metric_type, row.date, row.granularity))
+            (to_update if row.pk else to_create).append(row)
+        
+        if to_update:
+            HRMetric.objects.bulk_update(to_update, self.UPDATE_FIELDS)
+        if to_create:
+            HRMetric.objects.bulk_create(to_create)
+
+
+def period_start(date, granularity):
+    """First day of the day/month/quarter/year period containing `date`"""
+    if granularity == 'month':
+        return date.replace(day=1)
+    if granularity == 'quarter':
+        return date.replace(month=(date.month - 1) // 3 * 3 + 1, day=1)
+    if granularity == 'year':
+        return date.replace(month=1, day=1)
+    return date
 
 
 class MetricsCalculator:
     """Utility class for calculating HR metrics"""
     
+    # How daily rows combine into month/quarter/year rollups: stock metrics
+    # keep the latest value in the period, flow metrics are summed and rates
+    # are recomputed from the summed counts
+    ROLLUP_METHODS = {
+        'headcount': 'last',
+        'attrition_rate': 'rate',
+        'average_tenure': 'last',
+        'new_hires': 'sum',
+        'terminations': 'sum',
+        'leave_utilization': 'last',
+        'diversity_ratio': 'last',
+        'promotion_rate': 'sum',
+    }
+    
+    # Monthly flow metrics dated on the 1st of a month that cover the month before
+    PREVIOUS_MONTH_METRICS = {'attrition_rate', 'new_hires'}
+    
+    def __init__(self, writer=None):
+        self.writer = writer or HRMetricWriter()
+    
     def calculate_all_metrics(self, start_date=None, end_date=None):
         """Calculate all HR metrics for the specified date range"""
         if not end_date:
@@ -188,9 +798,17 @@ class MetricsCalculator:
         if not start_date:
             start_date = end_date - timedelta(days=30)
         
+        with transaction.atomic():
+            self.compute_metrics(start_date, end_date)
+            self.refresh_rollups(start_date, end_date)
+    
+    def compute_metrics(self, start_date, end_date):
+        """Queue every metric for the date range on the writer without flushing it"""
+        self._calculate_headcount_range(start_date, end_date)
+        
         current_date = start_date
         while current_date <= end_date:
-            self.calculate_metrics_for_date(current_date)
+            self._calculate_monthly_metrics(current_date)
             current_date += timedelta(days=1)
     
     def calculate_metrics_for_date(self, date):
@@ -198,6 +816,144 @@ class MetricsCalculator:
         # Headcount
         self._calculate_headcount(date)
         
+        self._calculate_monthly_metrics(date)
+        
+        self.refresh_rollups(date, date)
+    
+    def refresh_rollups(self, start_date, end_date):
+        """
+        Flush pending rows, then rebuild the month, quarter and year rollups
+        of every period touching the date range.
+        
+        Months are rolled up from daily rows, quarters and years from months.
+        Flow metrics in PREVIOUS_MONTH_METRICS roll up into the month before
+        their date, so the previous year is rebuilt too when the range
+        starts in January.
+        """
+        self.writer.flush()
+        
+        daily = HRMetric.objects.filter(
+            granularity='day',
+            date__range=[period_start(start_date, 'month'), self._period_end(end_date, 'month')]
+        )
+        self._add_rollups(daily, ['month'])
+        self.writer.flush()
+        
+        previous_month = period_start(start_date, 'month') - timedelta(days=1)
+        monthly = HRMetric.objects.filter(
+            granularity='month',
+            date__range=[period_start(previous_month, 'year'), self._period_end(end_date, 'year')]
+        )
+        self._add_rollups(monthly, ['quarter', 'year'])
+        self.writer.flush()
+    
+    def _period_end(self, date, granularity):
+        if granularity == 'year':
+            return date.replace(month=12, day=31)
+        next_month = date.replace(day=28) + timedelta(days=4)
+        return next_month - timedelta(days=next_month.day)
+    
+    def _period_covered(self, metric_type, date, granularity):
+        """First day of the period whose data a stored row describes"""
+        if granularity == 'day' and metric_type in self.PREVIOUS_MONTH_METRICS:
+            return period_start(date - timedelta(days=1), 'month')
+        return date
+    
+    def _add_rollups(self, queryset, granularities):
+        rows = queryset.order_by('date').values_list(
+            'metric_type', 'department_id', 'date', 'granularity', 'value', 'percentage_value',
+            'calculation_details'
+        )
+        rollups = {}
+        for row in rows.iterator(chunk_size=5000):
+            metric_type, dept_id, date, source_granularity, value, percentage_value, details = row
+            method = self.ROLLUP_METHODS.get(metric_type, 'last')
+            date = self._period_covered(metric_type, date, source_granularity)
+            for granularity in granularities:
+                key = (metric_type, dept_id, period_start(date, granularity), granularity)
+                rollup = rollups.setdefault(key, {
+                    'value': 0, 'percentage_value': None, 'source_rows': 0, 'avg_headcount': 0
+                })
+                rollup['source_rows'] += 1
+                if method == 'last':
+                    rollup['value'] = value
+                    rollup['percentage_value'] = percentage_value
+                elif method == 'rate':
+                    rollup['value'] += value
+                    rollup['avg_headcount'] += details.get('avg_headcount', 0)
+                else:
+                    rollup['value'] += value
+                    if percentage_value is not None:
+                        rollup['percentage_value'] = (rollup['percentage_value'] or 0) + percentage_value
+        
+        for (metric_type, dept_id, date, granularity), rollup in rollups.items():
+            method = self.ROLLUP_METHODS.get(metric_type, 'last')
+            calculation_details = {'rollup': method, 'source_rows': rollup['source_rows']}
+            if method == 'rate':
+                # The rate over the period is its total count over the
+                # average of the monthly average headcounts
+                avg_headcount = rollup['avg_headcount'] / rollup['source_rows']
+                rollup['percentage_value'] = float(rollup['value']) / avg_headcount * 100 if avg_headcount else 0
+                calculation_details.update({
+                    'terminations': int(rollup['value']),
+                    'avg_headcount': avg_headcount,
+                    'rate_percentage': rollup['percentage_value']
+                })
+            self.writer.add(
+                metric_type, date,
+                department_id=dept_id,
+                granularity=granularity,
+                value=rollup['value'],
+                percentage_value=rollup['percentage_value'],
+                calculation_details=calculation_details
+            )
+    
+    def apply_pending_deltas(self):
+        """
+        Bring stored metrics up to date with the recorded MetricDelta rows.
+        
+        Only metrics that were already calculated are touched: headcount for
+        the affected departments (and the company total) from the earliest
+        effective date onwards, and the monthly metrics dated on or after it.
+        """
+        deltas = MetricDelta.objects.filter(processed_at__isnull=True)
+        delta_ids = list(deltas.values_list('pk', flat=True))
+        if not delta_ids:
+            return 0
+        
+        deltas = MetricDelta.objects.filter(pk__in=delta_ids)
+        affected = dict(
+            deltas.order_by().values_list('department_id').annotate(since=Min('effective_date'))
+        )
+        since = min(affected.values())
+        stored = HRMetric.objects.filter(metric_type='headcount', granularity='day', date__gte=since).aggregate(
+            first=Min('date'), last=Max('date')
+        )
+        
+        with transaction.atomic():
+            if stored['last']:
+                department_ids = [dept_id for dept_id in affected if dept_id is not None]
+                self._calculate_headcount_range(stored['first'], stored['last'], department_ids)
+                
+                month_starts = HRMetric.objects.filter(
+                    granularity='day',
+                    department__isnull=True,
+                    date__gte=since,
+                    date__lte=stored['last'],
+                    date__day=1
+                ).exclude(metric_type='headcount').order_by('date').values_list('date', flat=True).distinct()
+                for date in month_starts:
+                    self._calculate_monthly_metrics(date)
+                
+                self.refresh_rollups(stored['first'], stored['last'])
+            
+            self.writer.flush()
+            deltas.update(processed_at=timezone.now())
+        
+        return len(delta_ids)
+    
+    def _calculate_monthly_metrics(self, date):
+        """Calculate the metrics that are only tracked monthly"""
         # Attrition rate (monthly)
         if date.day == 1:  # Calculate monthly on first day of month
             self._calculate_attrition_rate(date)
@@ -207,46 +963,29 @@ class MetricsCalculator:
     
     def _calculate_headcount(self, date):
         """Calculate total headcount by department"""
-        # Total headcount
-        total_count = Employee.objects.filter(
-            Q(hire_date__lte=date) &
-            (Q(termination_date__isnull=True) | Q(termination_date__gt=date))
-        ).count()
-        
-        HRMetric.objects.update_or_create(
-            metric_type='headcount',
-            date=date,
-            department=None,
-            defaults={
-                'value': total_count,
-                'month': date.month,
-                'year': date.year,
-                'quarter': (date.month - 1) // 3 + 1,
-                'calculation_details': {'total_employees': total_count}
-            }
-        )
+        self._calculate_headcount_range(date, date)
+    
+    def _calculate_headcount_range(self, start_date, end_date, department_ids=None):
+        """Calculate total and per-department headcount for every day in the range"""
+        dates, department_ids, counts, totals = headcount_series(start_date, end_date, department_ids)
         
-        # By department
-        departments = Department.objects.all()
-        for dept in departments:
-            dept_count = Employee.objects.filter(
-                Q(department=dept) &
-                Q(hire_date__lte=date) &
-                (Q(termination_date__isnull=True) | Q(termination_date__gt=date))
-            ).count()
-            
-            HRMetric.objects.update_or_create(
-                metric_type='headcount',
-                date=date,
-                department=dept,
-                defaults={
-                    'value': dept_count,
-                    'month': date.month,
-                    'year': date.year,
-                    'quarter': (date.month - 1) // 3 + 1,
-                    'calculation_details': {'department_employees': dept_count}
-                }
+        for day, date in enumerate(dates):
+            total_count = int(totals[day])
+            self.writer.add(
+                'headcount', date,
+                value=total_count,
+                calculation_details={'total_employees': total_count}
             )
+            
+            # By department
+            for row, dept_id in enumerate(department_ids):
+                dept_count = int(counts[row, day])
+                self.writer.add(
+                    'headcount', date,
+                    department_id=dept_id,
+                    value=dept_count,
+                    calculation_details={'department_employees': dept_count}
+                )
     
     def _calculate_attrition_rate(self, date):
         """Calculate monthly attrition rate"""
@@ -265,39 +1004,29 @@ class MetricsCalculator:
             month_end = date.replace(month=prev_month + 1, day=1) - timedelta(days=1)
         
         # Count terminations in the month
-        terminations = Employee.objects.filter(
+        terminations = with_termination_date(Employee.objects.all()).filter(
             termination_date__range=[month_start, month_end]
         ).count()
         
         # Average headcount during the month
-        start_headcount = Employee.objects.filter(
-            Q(hire_date__lt=month_start) &
+        start_headcount = with_termination_date(Employee.objects.all()).filter(
+            Q(date_of_joining__lt=month_start) &
             (Q(termination_date__isnull=True) | Q(termination_date__gte=month_start))
         ).count()
         
-        end_headcount = Employee.objects.filter(
-            Q(hire_date__lte=month_end) &
-            (Q(termination_date__isnull=True) | Q(termination_date__gt=month_end))
-        ).count()
+        end_headcount = active_employees(month_end).count()
         
         avg_headcount = (start_headcount + end_headcount) / 2 if (start_headcount + end_headcount) > 0 else 1
         attrition_rate = (terminations / avg_headcount) * 100
         
-        HRMetric.objects.update_or_create(
-            metric_type='attrition_rate',
-            date=date,
-            department=None,
-            defaults={
-                'value': terminations,
-                'percentage_value': attrition_rate,
-                'month': date.month,
-                'year': date.year,
-                'quarter': (date.month - 1) // 3 + 1,
-                'calculation_details': {
-                    'terminations': terminations,
-                    'avg_headcount': avg_headcount,
-                    'rate_percentage': attrition_rate
-                }
+        self.writer.add(
+            'attrition_rate', date,
+            value=terminations,
+            percentage_value=attrition_rate,
+            calculation_details={
+                'terminations': terminations,
+                'avg_headcount': avg_headcount,
+                'rate_percentage': attrition_rate
             }
         )
     
@@ -317,99 +1046,92 @@ class MetricsCalculator:
             month_end = date.replace(month=prev_month + 1, day=1) - timedelta(days=1)
         
         new_hires = Employee.objects.filter(
-            hire_date__range=[month_start, month_end]
+            date_of_joining__range=[month_start, month_end]
         ).count()
         
-        HRMetric.objects.update_or_create(
-            metric_type='new_hires',
-            date=date,
-            department=None,
-            defaults={
-                'value': new_hires,
-                'month': date.month,
-                'year': date.year,
-                'quarter': (date.month - 1) // 3 + 1,
-                'calculation_details': {'new_hires_count': new_hires}
-            }
+        self.writer.add(
+            'new_hires', date,
+            value=new_hires,
+            calculation_details={'new_hires_count': new_hires}
         )
     
     def _calculate_average_tenure(self, date):
-        """Calculate average employee tenure"""
-        active_employees = Employee.objects.filter(
-            Q(hire_date__lte=date) &
-            (Q(termination_date__isnull=True) | Q(termination_date__gt=date))
+        """Calculate average employee tenure, company-wide and by department"""
+        tenure = ExpressionWrapper(
+            Value(date, output_field=DateField()) - F('date_of_joining'),
+            output_field=DurationField()
         )
-        
-        if active_employees.exists():
-            total_tenure_days = sum(
-                (date - emp.hire_date).days for emp in active_employees
+        by_department = {
+            row['department_id']: row
+            for row in active_employees(date).order_by().values('department_id').annotate(
+                employees=Count('pk'),
+                total_tenure=Sum(tenure)
             )
-            avg_tenure_days = total_tenure_days / active_employees.count()
-            avg_tenure_years = avg_tenure_days / 365.25
-        else:
-            avg_tenure_years = 0
+        }
         
-        HRMetric.objects.update_or_create(
-            metric_type='average_tenure',
-            date=date,
-            department=None,
-            defaults={
-                'value': round(avg_tenure_years, 2),
-                'month': date.month,
-                'year': date.year,
-                'quarter': (date.month - 1) // 3 + 1,
-                'calculation_details': {
-                    'average_tenure_years': avg_tenure_years,
-                    'total_employees': active_employees.count()
-                }
+        def tenure_years(employees, total_tenure):
+            return total_tenure.days / employees / 365.25 if employees else 0
+        
+        total_employees = sum(row['employees'] for row in by_department.values())
+        total_tenure = sum((row['total_tenure'] for row in by_department.values()), timedelta())
+        avg_tenure_years = tenure_years(total_employees, total_tenure)
+        
+        self.writer.add(
+            'average_tenure', date,
+            value=round(avg_tenure_years, 2),
+            calculation_details={
+                'average_tenure_years': avg_tenure_years,
+                'total_employees': total_employees
             }
         )
+        
+        for dept_id in Department.objects.values_list('pk', flat=True):
+            row = by_department.get(dept_id, {'employees': 0, 'total_tenure': timedelta()})
+            dept_tenure_years = tenure_years(row['employees'], row['total_tenure'])
+            self.writer.add(
+                'average_tenure', date,
+                department_id=dept_id,
+                value=round(dept_tenure_years, 2),
+                calculation_details={
+                    'average_tenure_years': dept_tenure_years,
+                    'department_employees': row['employees']
+                }
+            )
     
     def _calculate_leave_utilization(self, date):
-        """Calculate leave utilization metrics"""
-        # This assumes you have LeaveBalance and LeaveRequest models
-        try:
-            from leave.models import LeaveBalance, LeaveRequest
-            
-            # Get all active employees
-            active_employees = Employee.objects.filter(
-               Q(hire_date__lte=date) &
-                (Q(termination_date__isnull=True) | Q(termination_date__gt=date))
+        """Calculate leave utilization, company-wide and by department"""
+        by_department = {
+            row['employee__department_id']: row
+            for row in LeaveBalance.objects.filter(
+                year=date.year,
+                employee__in=active_employees(date).values('pk')
+            ).order_by().values('employee__department_id').annotate(
+                allocated=Sum('total_days'),
+                used=Sum('used_days')
             )
-            
-            total_allocated = 0
-            total_used = 0
-            
-            for employee in active_employees:
-                # Get leave balances for the employee
-                balances = LeaveBalance.objects.filter(
-                    employee=employee,
-                    year=date.year
-                )
-                
-                for balance in balances:
-                    total_allocated += balance.total_days
-                    total_used += balance.used_days
-            
-            utilization_rate = (total_used / total_allocated * 100) if total_allocated > 0 else 0
-            
-            HRMetric.objects.update_or_create(
-                metric_type='leave_utilization',
-                date=date,
-                department=None,
-                defaults={
-                    'value': total_used,
-                    'percentage_value': utilization_rate,
-                    'month': date.month,
-                    'year': date.year,
-                    'quarter': (date.month - 1) // 3 + 1,
-                    'calculation_details': {
-                        'total_allocated': total_allocated,
-                        'total_used': total_used,
-                        'utilization_rate': utilization_rate
-                    }
+        }
+        
+        def add_utilization(dept_id, total_allocated, total_used):
+            total_used = float(total_used or 0)
+            utilization_rate = (total_used / total_allocated * 100) if total_allocated else 0
+            self.writer.add(
+                'leave_utilization', date,
+                department_id=dept_id,
+                value=total_used,
+                percentage_value=utilization_rate,
+                calculation_details={
+                    'total_allocated': total_allocated or 0,
+                    'total_used': total_used,
+                    'utilization_rate': utilization_rate
                 }
             )
-        except ImportError:
-            # Leave models not available
-            pass
\ No newline at end of file
+        
+        add_utilization(
+            None,
+            sum(row['allocated'] for row in by_department.values()),
+            sum(row['used'] for row in by_department.values())
+        )
+        
+        for dept_id in Department.objects.values_list('pk', flat=True):
+            row = by_department.get(dept_id, {'allocated': 0, 'used': 0})
+            add_utilization(dept_id, row['allocated'], row['used'])
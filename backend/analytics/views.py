@@ -4,14 +4,23 @@ from rest_framework.response import Response
 from django.db.models import Count, Avg, Q, Sum
 from django.utils import timezone
 from datetime import datetime, timedelta
-from django.http import HttpResponse
-from .models import Report, ReportExecution, Certificate, HRMetric
+from django.conf import settings
+from django.core.cache import cache
+import hashlib
+import numpy as np
+from .models import Report, ReportExecution, Certificate, HRMetric, MetricsJob, DataVersion
 from .serializers import (
     ReportSerializer, ReportExecutionSerializer, 
-    CertificateSerializer, HRMetricSerializer
+    CertificateSerializer, HRMetricSerializer, MetricsJobSerializer
 )
-from .utils import ReportGenerator, MetricsCalculator
-from .tasks import generate_report_task, send_certificate_reminders
+from .utils import (
+    ReportGenerator, downsample_lttb, hr_metric_version_keys, period_start,
+    report_data_version, report_fingerprint
+)
+from .cube import hr_metric_cube
+from .custom_reports import AGGREGATES, DATE_PARTS, ENTITIES, OPERATORS
+from .downloads import serve_file
+from .tasks import queue_report_generation, send_report_email, send_certificate_reminders, start_metrics_job
 
 
 class ReportViewSet(viewsets.ModelViewSet):
@@ -26,16 +35,45 @@ class ReportViewSet(viewsets.ModelViewSet):
     def execute(self, request, pk=None):
         """Execute a report immediately"""
         report = self.get_object()
+        fingerprint = report_fingerprint(report)
+        data_version = report_data_version(report)
+        
+        # Reuse the file of an identical run if none of its data has changed
+        previous = ReportExecution.find_reusable(fingerprint, data_version)
+        if previous:
+            now = timezone.now()
+            execution = ReportExecution(
+                report=report,
+                executed_by=request.user.employee_profile,
+                status='completed',
+                completed_at=now,
+                execution_time=timedelta(0),
+                record_count=previous.record_count,
+                fingerprint=fingerprint,
+                data_version=data_version
+            )
+            execution.share_output(previous)
+            execution.save()
+            if report.email_recipients:
+                send_report_email.delay(execution.id)
+            
+            return Response({
+                'execution_id': execution.id,
+                'message': 'Report reused from an identical earlier run',
+                'reused_execution_id': previous.id
+            })
         
         # Create execution record
         execution = ReportExecution.objects.create(
             report=report,
             executed_by=request.user.employee_profile,
-            status='pending'
+            status='pending',
+            fingerprint=fingerprint,
+            data_version=data_version
         )
         
         # Queue the report generation task
-        generate_report_task.delay(execution.id)
+        queue_report_generation(execution)
         
         return Response({
             'execution_id': execution.id,
@@ -49,12 +87,8 @@ class ReportViewSet(viewsets.ModelViewSet):
         generator = ReportGenerator()
         
         try:
-            data = generator.get_report_data(report)
-            return Response({
-                'columns': data.get('columns', []),
-                'data': data.get('data', [])[:10],  # First 10 records for preview
-                'total_records': len(data.get('data', []))
-            })
+            # First 10 records for preview
+            return Response(generator.get_report_preview(report, limit=10))
         except Exception as e:
             return Response({
                 'error': str(e)
@@ -87,6 +121,18 @@ class ReportViewSet(viewsets.ModelViewSet):
                 'name': 'Certificate Expiry Report',
                 'description': 'Upcoming certificate expirations',
                 'default_columns': ['employee_id', 'employee_name', 'certificate_name', 'expiry_date', 'days_until_expiry']
+            },
+            {
+                'type': 'custom',
+                'name': 'Custom Report',
+                'description': 'Ad-hoc query over a base entity with joins, filters, grouping and aggregates',
+                'entities': {
+                    name: {'fields': entity.fields, 'joins': list(entity.joins)}
+                    for name, entity in ENTITIES.items()
+                },
+                'operators': list(OPERATORS),
+                'aggregates': list(AGGREGATES),
+                'date_parts': list(DATE_PARTS)
             }
         ]
         return Response(templates)
@@ -106,20 +152,42 @@ class ReportExecutionViewSet(viewsets.ReadOnlyModelViewSet):
     
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
-        """Download generated report file"""
+        """Download generated report file, honouring Range and conditional requests"""
         execution = self.get_object()
         
-        if not execution.file:
+        if not execution.has_output:
             return Response({
                 'error': 'No file available for this execution'
             }, status=status.HTTP_404_NOT_FOUND)
         
-        response = HttpResponse(
-            execution.file.read(),
-            content_type='application/octet-stream'
-        )
-        response['Content-Disposition'] = f'attachment; filename="{execution.file.name}"'
-        return response
+        if execution.blob_id:
+            blob = execution.blob
+            return serve_file(
+                request, blob.file, execution.output_name,
+                size=blob.size, digest=blob.digest, gzipped=True
+            )
+        return serve_file(request, execution.file)
+    
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """Stop a pending or running report execution"""
+        execution = self.get_object()
+        
+        if execution.status not in ('pending', 'running'):
+            return Response({
+                'error': f'Execution is already {execution.status}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Pending executions are cancelled outright; running ones stop at
+        # the next chunk boundary
+        executions = ReportExecution.objects.filter(id=execution.id)
+        executions.update(cancel_requested=True)
+        executions.filter(status='pending').update(status='cancelled', completed_at=timezone.now())
+        
+        return Response({
+            'execution_id': execution.id,
+            'message': 'Cancellation requested'
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 class CertificateViewSet(viewsets.ModelViewSet):
@@ -224,8 +292,25 @@ class HRMetricViewSet(viewsets.ModelViewSet):
         if department_id:
             queryset = queryset.filter(department_id=department_id)
         
+        # Filter by granularity; plain listings show the daily rows
+        granularity = self.request.query_params.get('granularity')
+        if granularity:
+            queryset = queryset.filter(granularity=granularity)
+        elif self.action == 'list':
+            queryset = queryset.filter(granularity='day')
+        
         return queryset
     
+    def get_dashboard_granularity(self, start_date, end_date):
+        """Coarsest rollup that still gives enough points for a trend chart"""
+        min_points = getattr(settings, 'HR_DASHBOARD_MIN_POINTS', 24)
+        months = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1
+        
+        for granularity, points in [('year', months / 12), ('quarter', months / 3), ('month', months)]:
+            if points >= min_points:
+                return granularity
+        return 'day'
+    
     @action(detail=False, methods=['get'])
     def dashboard(self, request):
         """Get dashboard metrics for specified time period"""
@@ -239,49 +324,154 @@ class HRMetricViewSet(viewsets.ModelViewSet):
         if request.query_params.get('end_date'):
             end_date = datetime.strptime(request.query_params.get('end_date'), '%Y-%m-%d').date()
         
+        max_points = request.query_params.get('max_points')
+        if max_points is not None:
+            try:
+                max_points = int(max_points)
+            except ValueError:
+                max_points = None
+            # LTTB always keeps both end points plus one point per bucket
+            if max_points is None or max_points < 3:
+                return Response({
+                    'error': 'max_points must be an integer of at least 3'
+                }, status=status.HTTP_400_BAD_REQUEST)
+        
+        granularity = request.query_params.get('granularity') or self.get_dashboard_granularity(start_date, end_date)
+        if granularity not in dict(HRMetric.GRANULARITY_CHOICES):
+            return Response({
+                'error': f"granularity must be one of: {', '.join(dict(HRMetric.GRANULARITY_CHOICES))}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        # Rollup rows are dated on the first day of their period
+        start_date = period_start(start_date, granularity)
+        
+        # Cached per window and filters; any write to a month in the window
+        # bumps its version and so changes the key
+        versions = DataVersion.current(hr_metric_version_keys(start_date, end_date))
+        cache_key = 'hr_dashboard:' + hashlib.sha1(repr((
+            start_date, end_date, granularity, sorted(request.query_params.items()), versions
+        )).encode()).hexdigest()
+        dashboard_data = cache.get(cache_key)
+        if dashboard_data is not None:
+            return Response(dashboard_data)
+        
         metrics = self.get_queryset().filter(
+            granularity=granularity,
             date__range=[start_date, end_date]
         )
+        # One series per metric: a department's rows, or else the company-wide rows
+        if not request.query_params.get('department_id'):
+            metrics = metrics.filter(department__isnull=True)
+        metrics = metrics.order_by('metric_type', 'date').values_list(
+            'metric_type', 'date', 'value', 'percentage_value'
+        )
         
-        # Group metrics by type
-        dashboard_data = {}
+        # Group metrics by type in a single pass
+        dashboard_data = {
+            metric_type: {'current_value': 0, 'granularity': granularity, 'trend_data': []}
+            for metric_type, _ in HRMetric.METRIC_TYPES
+        }
         
-        for metric_type, _ in HRMetric.METRIC_TYPES:
-            metric_data = metrics.filter(metric_type=metric_type).order_by('date')
-            
-            dashboard_data[metric_type] = {
-                'current_value': metric_data.last().value if metric_data.exists() else 0,
-                'trend_data': [
-                    {
-                        'date': m.date.isoformat(),
-                        'value': float(m.value),
-                        'percentage_value': float(m.percentage_value) if m.percentage_value else None
-                    }
-                    for m in metric_data
-                ]
-            }
+        for metric_type, date, value, percentage_value in metrics:
+            if metric_type not in dashboard_data:
+                continue
+            dashboard_data[metric_type]['current_value'] = value
+            dashboard_data[metric_type]['trend_data'].append({
+                'date': date.isoformat(),
+                'value': float(value),
+                'percentage_value': float(percentage_value) if percentage_value else None
+            })
         
+        # Keep long series to a bounded number of shape-preserving points
+        if max_points:
+            for entry in dashboard_data.values():
+                trend_data = entry['trend_data']
+                if len(trend_data) > max_points:
+                    days = np.array([point['date'] for point in trend_data], dtype='datetime64[D]')
+                    keep = downsample_lttb(
+                        days.astype(np.int64),
+                        [point['value'] for point in trend_data],
+                        max_points
+                    )
+                    entry['trend_data'] = [trend_data[i] for i in keep]
+        
+        cache.set(cache_key, dashboard_data, getattr(settings, 'HR_DASHBOARD_CACHE_TIMEOUT', 3600))
         return Response(dashboard_data)
     
-    @action(detail=False, methods=['post'])
-    def calculate(self, request):
-        """Trigger metrics calculation for specified date range"""
-        calculator = MetricsCalculator()
-        
-        start_date = request.data.get('start_date')
-        end_date = request.data.get('end_date')
+    @action(detail=False, methods=['get'])
+    def cube(self, request):
+        """Slice and aggregate metrics from the in-memory metrics cube"""
+        params = request.query_params
         
-        if start_date:
-            start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
-        if end_date:
-            end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+        def split(name):
+            return [item for item in params.get(name, '').split(',') if item]
         
         try:
-            calculator.calculate_all_metrics(start_date, end_date)
+            start_date = params.get('start_date')
+            end_date = params.get('end_date')
+            if start_date:
+                start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+            if end_date:
+                end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+            
+            group_by = split('group_by') or ['month']
+            rollup = params.get('rollup', 'sum')
+            measure = params.get('measure', 'value')
+            results = hr_metric_cube.query(
+                metric_types=split('metric_type'),
+                start_date=start_date,
+                end_date=end_date,
+                department_ids=split('department_id'),
+                locations=split('location'),
+                group_by=group_by,
+                rollup=rollup,
+                measure=measure
+            )
+        except ValueError as e:
             return Response({
-                'message': 'Metrics calculation completed successfully'
-            })
-        except Exception as e:
+                'error': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'group_by': group_by,
+            'rollup': rollup,
+            'measure': measure,
+            'results': results
+        })
+    
+    @action(detail=False, methods=['post'])
+    def calculate(self, request):
+        """Start a background metrics calculation for specified date range"""
+        end_date = timezone.now().date()
+        start_date = None
+        
+        try:
+            if request.data.get('end_date'):
+                end_date = datetime.strptime(request.data.get('end_date'), '%Y-%m-%d').date()
+            if request.data.get('start_date'):
+                start_date = datetime.strptime(request.data.get('start_date'), '%Y-%m-%d').date()
+        except ValueError as e:
             return Response({
                 'error': str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        if not start_date:
+            start_date = end_date - timedelta(days=30)
+        if start_date > end_date:
+            return Response({
+                'error': 'start_date must not be after end_date'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        job = MetricsJob.objects.create(
+            requested_by=getattr(request.user, 'employee_profile', None),
+            start_date=start_date,
+            end_date=end_date
+        )
+        start_metrics_job(job)
+        
+        return Response(MetricsJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class MetricsJobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = MetricsJob.objects.all()
+    serializer_class = MetricsJobSerializer
+    permission_classes = [permissions.IsAuthenticated]
\ No newline at end of file
@@ -182,6 +182,46 @@ CELERY_TIMEZONE = 'UTC'  # or your timezone like 'Asia/Kolkata'
 # Optional: Task result expiration time
 CELERY_RESULT_EXPIRES = 3600
 
+# Task queues. Run one worker per queue, e.g.
+#   celery -A backend worker -Q interactive
+# Report generation is routed per execution: interactive runs, scheduled
+# runs, or heavy for reports estimated above REPORT_HEAVY_ROWS.
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+CELERY_TASK_ROUTES = {
+    'analytics.tasks.generate_report_task': {'queue': 'interactive'},
+    'analytics.tasks.send_report_email': {'queue': 'notifications'},
+    'analytics.tasks.send_certificate_reminders': {'queue': 'notifications'},
+    'analytics.tasks.generate_scheduled_reports': {'queue': 'scheduled'},
+    'analytics.tasks.update_certificate_statuses': {'queue': 'scheduled'},
+    'analytics.tasks.collect_report_blobs': {'queue': 'scheduled'},
+    'analytics.tasks.apply_metric_deltas': {'queue': 'scheduled'},
+    'analytics.tasks.calculate_metrics_chunk': {'queue': 'heavy'},
+}
+
+# Worker concurrency used when a worker consumes a single queue and no
+# --concurrency is given
+CELERY_QUEUE_CONCURRENCY = {
+    'interactive': 4,
+    'scheduled': 2,
+    'heavy': 1,
+    'notifications': 2,
+}
+
+# Estimated rows above which a report is generated on the heavy queue
+REPORT_HEAVY_ROWS = {
+    'pdf': 10000,
+    'excel': 200000,
+    'csv': 500000,
+    'parquet': 1000000,
+    'arrow': 1000000,
+}
+
+# Notification emails are sent in batches of MAIL_BATCH_SIZE messages per
+# connection, at no more than MAIL_RATE_LIMIT messages per second (None
+# disables throttling)
+MAIL_BATCH_SIZE = 100
+MAIL_RATE_LIMIT = None
+
 
 # Optional: For development - makes tasks run synchronously
 CELERY_TASK_ALWAYS_EAGER = True  # Only for development/testing
\ No newline at end of file